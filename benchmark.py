@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import contextlib
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from Crypto.Cipher import AES
+import downloader
+import decrypt
+import package
+import throttle
+
+class MockCatalog:
+    """Catalog served by the mock server; ids, keys and segments are derived from the configuration only.
+
+    Segments are AES-128 encrypted without an explicit IV, so the media sequence number is used.
+    Their content is made of null TS packets, or of consecutive slices of source when given.
+    With key_rotation the key changes every key_rotation segments, cycling through three kinds of
+    group: without explicit IV, with an explicit IV, and in clear (METHOD=NONE).
+    """
+    TS_PACKET_SIZE = 188
+
+    def __init__(self, trainers, courses, lessons, segments, segment_size, source=None, key_rotation=None):
+        self.trainers = trainers
+        self.courses = courses
+        self.lessons = lessons
+        self.segments = segments
+        self.segment_size = segment_size - segment_size % MockCatalog.TS_PACKET_SIZE
+        self.key_rotation = key_rotation
+        self.__source = None
+        if source is not None:
+            with open(source, 'rb') as s:
+                data = s.read()
+            self.__source = data[:len(data) - len(data) % MockCatalog.TS_PACKET_SIZE]
+
+    def GetTrainers(self):
+        return ['t{}'.format(x) for x in range(self.trainers)]
+
+    def GetCourses(self, trainer):
+        return ['{}c{}'.format(trainer, x) for x in range(self.courses)]
+
+    def GetLessons(self, course):
+        return ['{}l{}'.format(course, x) for x in range(self.lessons)]
+
+    def GetKey(self, lesson, group=0):
+        name = lesson if group == 0 else '{}/{}'.format(lesson, group)
+        return hashlib.sha256(name.encode()).digest()[:16]
+
+    def GetKeyGroup(self, index):
+        return index // self.key_rotation if self.key_rotation else 0
+
+    def GetKeyTag(self, group):
+        """EXT-X-KEY line of the segments in a key group."""
+        if group % 3 == 2:
+            return '#EXT-X-KEY:METHOD=NONE'
+        uri = 'key.bin' if group == 0 else 'key{}.bin'.format(group)
+        if group % 3 == 1:
+            return '#EXT-X-KEY:METHOD=AES-128,URI="{}",IV=0x{}'.format(uri, self.__getExplicitIV(group).hex())
+        return '#EXT-X-KEY:METHOD=AES-128,URI="{}"'.format(uri)
+
+    def GetSegment(self, lesson, index):
+        plain = self.GetPlain(index)
+        group = self.GetKeyGroup(index)
+        if group % 3 == 2:
+            return plain
+        padding = AES.block_size - len(plain) % AES.block_size
+        iv = self.__getExplicitIV(group) if group % 3 == 1 else index.to_bytes(16, 'big')
+        return AES.new(self.GetKey(lesson, group), AES.MODE_CBC, iv).encrypt(plain + bytes([padding]) * padding)
+
+    def GetPlain(self, index):
+        if self.__source is None:
+            packet = b'\x47\x1f\xff\x10' + b'\xff' * (MockCatalog.TS_PACKET_SIZE - 4)
+            return packet * (self.segment_size // MockCatalog.TS_PACKET_SIZE)
+        start = index * self.segment_size % len(self.__source)
+        plain = self.__source[start:start + self.segment_size]
+        return plain + self.__source[:self.segment_size - len(plain)]
+
+    def __getExplicitIV(self, group):
+        return hashlib.sha256('iv/{}'.format(group).encode()).digest()[:16]
+
+class MockHandler(BaseHTTPRequestHandler):
+    """The catalog API and the HLS playlists, keys and segments of every lesson."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.CountConnection()
+
+    def do_GET(self):
+        with self.server.Track(urllib.parse.urlparse(self.path).path):
+            self.__get()
+
+    def __get(self):
+        server = self.server
+        time.sleep(server.latency)
+        parsed = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(parsed.query)
+        catalog = server.catalog
+        if server.IsFailing([parsed.path] + ['{}?{}={}'.format(parsed.path, k, v[0]) for k, v in query.items()]):
+            return self.__send(b'', 'text/plain', 503)
+
+        if parsed.path == '/api/courses':
+            trainer = query['trainer_id'][0]
+            return self.__sendJson({'data': {'courses': [{'id': x} for x in catalog.GetCourses(trainer)]}})
+        if parsed.path == '/api/course':
+            course = query['course_id'][0]
+            lessons = catalog.GetLessons(course)
+            return self.__sendJson({'data': {
+                'title': 'Course {}'.format(course), 'highlights': 'Course {}'.format(course), 'summary': '', 'description': '',
+                'lesson_tot': len(lessons), 'trainers': [{'first_name': 'Bench', 'last_name': 'Mark'}],
+                'lessons': [{'id': x, 'lesson_num': i + 1, 'title': x, 'summary': '', 'description': ''} for i, x in enumerate(lessons)]
+            }})
+        if parsed.path == '/api/video':
+            lesson = query['lesson_id'][0]
+            url = 'http://{}:{}/{}/master.m3u8'.format(*server.server_address, lesson)
+            return self.__sendJson({'data': {'token': {'url': url, 'token_querystring': 'token={}'.format(server.GetToken())},
+                                             'lesson': {'lesson_num': int(lesson.rsplit('l', 1)[1]) + 1}}})
+
+        lesson, name = parsed.path.strip('/').split('/', 1)
+        if not server.IsTokenValid(query.get('token', [None])[0]):
+            return self.__send(b'', 'text/plain', 403)
+        if name == 'master.m3u8':
+            return self.__send(server.GetMaster(), 'application/vnd.apple.mpegurl')
+        if name == 'stream.m3u8':
+            return self.__send(server.GetPlaylist(), 'application/vnd.apple.mpegurl')
+        if name.startswith('key') and name.endswith('.bin'):
+            return self.__send(catalog.GetKey(lesson, int(name[len('key'):-len('.bin')] or 0)), 'application/octet-stream')
+        if name.startswith('segment') and name.endswith('.ts'):
+            if server.IsError():
+                return self.__send(b'', 'text/plain', 503)
+            return self.__sendSegment(catalog.GetSegment(lesson, int(name[len('segment'):-len('.ts')])))
+        self.__send(b'', 'text/plain', 404)
+
+    def __sendSegment(self, body):
+        """Send the segment, or its tail when asked with a bytes=N- Range header."""
+        server = self.server
+        requested = self.headers.get('range')
+        if requested is None:
+            if server.truncate:
+                # Announce the whole segment and drop the connection halfway through it.
+                self.send_response(200)
+                self.send_header('content-type', 'video/MP2T')
+                self.send_header('content-length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[:len(body) // 2])
+                self.close_connection = True
+                return
+            return self.__send(body, 'video/MP2T')
+        server.CountRange()
+        start = int(requested[len('bytes='):].split('-', 1)[0])
+        if start >= len(body):
+            return self.__send(b'', 'text/plain', 416, {'content-range': 'bytes */{}'.format(len(body))})
+        self.__send(body[start:], 'video/MP2T', 206, {'content-range': 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body))})
+
+    def __sendJson(self, body):
+        self.__send(json.dumps(body).encode(), 'application/json')
+
+    def __send(self, body, content_type, status=200, headers=None):
+        self.send_response(status)
+        self.send_header('content-type', content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        for start in range(0, len(body), MockServer.CHUNK_SIZE):
+            chunk = body[start:start + MockServer.CHUNK_SIZE]
+            self.server.Throttle(len(chunk))
+            self.wfile.write(chunk)
+
+class MockServer(ThreadingHTTPServer):
+    """Mock of the website; counts the connections accepted, the requests per path and the most requests served at once.
+
+    failures maps a path, or a path and one of its query parameters like /api/course?course_id=t0c0,
+    to the number of the next requests for it answered with a 503. With truncate, segments requested
+    without a Range header are cut halfway through, as by a dropped connection. With token_ttl, the
+    tokens given by the video API expire after token_ttl seconds, and playlists, keys and segments
+    requested with an expired token are refused with a 403. With rate, the responses of all the
+    connections share rate bytes per second, like the clients of a saturated link.
+    """
+    CHUNK_SIZE = 16 * 1024
+
+    daemon_threads = True
+
+    def __init__(self, catalog, latency=0, error_rate=0, seed=0, truncate=False, token_ttl=None, rate=None):
+        super().__init__(('127.0.0.1', 0), MockHandler)
+        self.catalog = catalog
+        self.latency = latency
+        self.error_rate = error_rate
+        self.truncate = truncate
+        self.token_ttl = token_ttl
+        self.__bucket = throttle.TokenBucket(rate, MockServer.CHUNK_SIZE) if rate else None
+        self.connections = 0
+        self.ranges = 0
+        self.requests = collections.Counter()
+        self.max_in_flight = 0
+        self.failures = collections.Counter()
+        self.__in_flight = 0
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+
+    def CountConnection(self):
+        with self.__lock:
+            self.connections += 1
+
+    def CountRange(self):
+        with self.__lock:
+            self.ranges += 1
+
+    @contextlib.contextmanager
+    def Track(self, path):
+        with self.__lock:
+            self.requests[path] += 1
+            self.__in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.__in_flight)
+        try:
+            yield
+        finally:
+            with self.__lock:
+                self.__in_flight -= 1
+
+    def IsFailing(self, keys):
+        with self.__lock:
+            for key in keys:
+                if self.failures[key] > 0:
+                    self.failures[key] -= 1
+                    return True
+            return False
+
+    def GetToken(self):
+        """The token is its expiry time, there is nothing to keep track of."""
+        if self.token_ttl is None:
+            return 'benchmark'
+        return '{:.3f}'.format(time.time() + self.token_ttl)
+
+    def IsTokenValid(self, token):
+        if self.token_ttl is None:
+            return True
+        try:
+            return time.time() < float(token)
+        except (TypeError, ValueError):
+            return False
+
+    def Throttle(self, amount):
+        if self.__bucket is not None:
+            self.__bucket.Consume(amount)
+
+    def IsError(self):
+        with self.__lock:
+            return self.__random.random() < self.error_rate
+
+    def GetMaster(self):
+        bandwidth = self.catalog.segment_size * 8 // 10
+        return ('#EXTM3U\n'
+                '#EXT-X-STREAM-INF:BANDWIDTH={},RESOLUTION=640x360,CODECS="avc1.4d401e,mp4a.40.2"\nlow.m3u8\n'
+                '#EXT-X-STREAM-INF:BANDWIDTH={},RESOLUTION=1280x720,CODECS="avc1.4d401f,mp4a.40.2"\nstream.m3u8\n').format(bandwidth // 4, bandwidth).encode()
+
+    def GetPlaylist(self):
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:10', '#EXT-X-MEDIA-SEQUENCE:0']
+        for index in range(self.catalog.segments):
+            group = self.catalog.GetKeyGroup(index)
+            if index == 0 or group != self.catalog.GetKeyGroup(index - 1):
+                lines.append(self.catalog.GetKeyTag(group))
+            lines += ['#EXTINF:10.0,', 'segment{}.ts'.format(index)]
+        lines.append('#EXT-X-ENDLIST')
+        return ('\n'.join(lines) + '\n').encode()
+
+def Serve(catalog, latency, error_rate, seed, rate, port):
+    server = MockServer(catalog, latency, error_rate, seed, rate=rate)
+    port.put(server.server_address[1])
+    server.serve_forever()
+
+@contextlib.contextmanager
+def MockProcess(catalog, latency, error_rate, seed, rate=None):
+    """Run the mock server in its own process, so that it doesn't compete for the GIL with what is measured."""
+    port = multiprocessing.Queue()
+    process = multiprocessing.Process(target=Serve, args=(catalog, latency, error_rate, seed, rate, port), daemon=True)
+    process.start()
+    try:
+        yield 'http://127.0.0.1:{}/'.format(port.get(timeout=10))
+    finally:
+        process.terminate()
+        process.join()
+
+@contextlib.contextmanager
+def Quiet():
+    """Silence stdout and stderr at the file descriptor level, child processes and progress bars included."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(os.devnull, 'w') as null:
+        os.dup2(null.fileno(), 1)
+        os.dup2(null.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+def GetCommit():
+    """Short hash of the checked out commit, with + appended when the tree has local changes."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if dirty else '')
+
+def GetTreeSize(root, extension):
+    size = 0
+    for path, _, files in os.walk(root):
+        size += sum(os.path.getsize(os.path.join(path, x)) for x in files if x.endswith(extension))
+    return size
+
+def RunOnce(uri, catalog, args):
+    """Download, decrypt and package the whole catalog in a scratch folder, returning seconds and bytes per stage."""
+    work_path = tempfile.mkdtemp(prefix='hls-benchmark-')
+    current_path = os.getcwd()
+    os.chdir(work_path)
+    try:
+        with open('cookies.txt', 'w') as c:
+            c.write('benchmark=1')
+        with open('trainers.txt', 'w') as t:
+            t.write('\n'.join(catalog.GetTrainers()) + '\n')
+
+        run = {}
+        with Quiet():
+            start = time.perf_counter()
+            downloader.Downloader(workers=args.workers, resolvers=args.resolvers, uri=uri).Download()
+            run['download'] = time.perf_counter() - start
+        run['download_bytes'] = GetTreeSize('./download', '.ts')
+
+        with Quiet():
+            start = time.perf_counter()
+            if args.jobs > 1:
+                decrypt.DecryptParallel('./download', args.jobs)
+            else:
+                decrypt.DecryptSerial('./download')
+            run['decrypt'] = time.perf_counter() - start
+        run['decrypt_bytes'] = GetTreeSize('./download', '.decrypted')
+
+        if args.package:
+            with Quiet():
+                start = time.perf_counter()
+                package.Package('./download', './package', args.jobs)
+                run['package'] = time.perf_counter() - start
+            run['package_bytes'] = GetTreeSize('./package', '.mp4')
+        return run
+    finally:
+        os.chdir(current_path)
+        shutil.rmtree(work_path, ignore_errors=True)
+
+def Summarize(runs):
+    """Median of every measure over the runs."""
+    return {key: statistics.median(x[key] for x in runs) for key in runs[0]}
+
+def LoadResults(path):
+    try:
+        with open(path, 'r') as r:
+            return [json.loads(x) for x in r if x.strip()]
+    except FileNotFoundError:
+        return []
+
+def PrintComparison(result, previous):
+    print("Commit {} ({} runs):".format(result['commit'], len(result['runs'])))
+    for stage in ['download', 'decrypt', 'package']:
+        if stage not in result['summary']:
+            continue
+        seconds = result['summary'][stage]
+        rate = result['summary'][stage + '_bytes'] / seconds / 1024 ** 2 if seconds else 0
+        line = "\t{:<10}{:8.3f}s {:10.1f} MiB/s".format(stage, seconds, rate)
+        if previous is not None and stage in previous['summary']:
+            before = previous['summary'][stage]
+            line += "   {:+.1f}% vs {}".format((seconds - before) / before * 100, previous['commit'])
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time download, decrypt and package against a local mock of the website.')
+    parser.add_argument('--trainers', type=int, default=1, help='Trainers in the mock catalog.')
+    parser.add_argument('--courses', type=int, default=2, help='Courses per trainer.')
+    parser.add_argument('--lessons', type=int, default=4, help='Lessons per course.')
+    parser.add_argument('--segments', type=int, default=20, help='Segments per lesson.')
+    parser.add_argument('--segment-size', type=int, default=512, help='Size of a segment in KiB.')
+    parser.add_argument('--latency', type=float, default=20, help='Latency of every response in milliseconds.')
+    parser.add_argument('--error-rate', type=float, default=0, help='Fraction of segment requests answered with a 503.')
+    parser.add_argument('--server-rate', type=int, default=None, help='Bandwidth in KiB/s shared by all the responses of the mock server; unlimited by default.')
+    parser.add_argument('--source', default=None, help='MPEG-TS file the segments are cut from; needed for the package stage to produce valid MP4s.')
+    parser.add_argument('--workers', type=int, default=8, help='Segments downloaded in parallel.')
+    parser.add_argument('--resolvers', type=int, default=4, help='Lessons resolved in parallel.')
+    parser.add_argument('--jobs', type=int, default=1, help='Processes used by decrypt and package.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of the whole pipeline; the median is reported.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the injected errors.')
+    parser.add_argument('--output', default='benchmark.jsonl', help='File the results are appended to, as JSON lines.')
+    args = parser.parse_args()
+    args.package = shutil.which('ffmpeg') is not None
+    if not args.package:
+        print("ffmpeg not found, the package stage is skipped.")
+
+    config = {key: getattr(args, key) for key in ['trainers', 'courses', 'lessons', 'segments', 'segment_size', 'latency', 'error_rate', 'source', 'workers', 'resolvers', 'jobs', 'package']}
+    if args.server_rate:
+        # Added only when set, so that results measured before the option existed are still compared.
+        config['server_rate'] = args.server_rate
+    catalog = MockCatalog(args.trainers, args.courses, args.lessons, args.segments, args.segment_size * 1024, args.source)
+    runs = []
+    with MockProcess(catalog, args.latency / 1000, args.error_rate, args.seed, args.server_rate and args.server_rate * 1024) as uri:
+        for index in range(args.repeat):
+            runs.append(RunOnce(uri, catalog, args))
+            print("Run {}/{}: {}.".format(index + 1, args.repeat, ', '.join("{} {:.3f}s".format(k, v) for k, v in runs[-1].items() if not k.endswith('_bytes'))))
+
+    result = {
+        'commit': GetCommit(),
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'config': config,
+        'runs': runs,
+        'summary': Summarize(runs)
+    }
+    previous = [x for x in LoadResults(args.output) if x['config'] == config and x['commit'] != result['commit']]
+    PrintComparison(result, previous[-1] if previous else None)
+    with open(args.output, 'a') as r:
+        r.write(json.dumps(result) + '\n')
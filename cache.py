@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+import time
+
+class ResponseCache:
+    """On-disk cache of JSON API responses, keyed by endpoint and parameters.
+
+    Entries younger than the TTL are used without contacting the server; older ones are
+    revalidated with If-None-Match/If-Modified-Since when the server provided an ETag or a
+    Last-Modified header.
+    """
+    def __init__(self, path='./cache/', ttl=24 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+
+        if not os.path.isdir(path):
+            os.mkdir(path)
+
+    def Load(self, uri, params):
+        try:
+            with open(self.__getPath(uri, params), 'r') as c:
+                return json.loads(c.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def IsFresh(self, entry, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        return time.time() - entry['fetched'] < ttl
+
+    def GetValidators(self, entry):
+        """Headers for a conditional request revalidating the entry."""
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def Store(self, uri, params, body, headers):
+        entry = {
+            'fetched': time.time(),
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+            'body': body
+        }
+        self.__write(uri, params, entry)
+
+    def Refresh(self, uri, params, entry):
+        """The server confirmed the entry is still valid."""
+        entry['fetched'] = time.time()
+        self.__write(uri, params, entry)
+
+    def __write(self, uri, params, entry):
+        path = self.__getPath(uri, params)
+        temp_path = path + '.part'
+        with open(temp_path, 'w') as c:
+            c.write(json.dumps(entry))
+        os.replace(temp_path, path)
+
+    def __getPath(self, uri, params):
+        key = json.dumps([uri, params], sort_keys=True)
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest() + '.json')
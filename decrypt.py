@@ -1,70 +1,347 @@
 #!/usr/bin/env python3
 from Crypto.Cipher import AES
 import os
+import json
+import collections
+import contextlib
+import argparse
+import concurrent.futures
+import time
 from progress.bar import ChargingBar
+import metrics
+import scan
+from manifest import Manifest
 
-class Decrypt:
-    def __init__(self):
+class SegmentDecryptor:
+    """Incremental AES-CBC decryption of a single segment, removing the PKCS7 padding at the end."""
+    __BLOCK_SIZE = AES.block_size
+
+    def __init__(self, key, iv, output, buffer):
+        self.__aes = AES.new(key, AES.MODE_CBC, iv)
+        self.__output = output
+        self.__buffer = buffer
+        self.__carry = bytearray()
+        self.__tail = bytearray()
+
+    def Update(self, data):
+        """Decrypt data, which doesn't need to be aligned to the block size."""
+        data = memoryview(data)
+        if self.__carry:
+            missing = SegmentDecryptor.__BLOCK_SIZE - len(self.__carry)
+            self.__carry += data[:missing]
+            data = data[missing:]
+            if len(self.__carry) < SegmentDecryptor.__BLOCK_SIZE:
+                return
+            block = bytes(self.__carry)
+            self.__carry.clear()
+            self.__decryptBlocks(memoryview(block))
+        aligned = len(data) - len(data) % SegmentDecryptor.__BLOCK_SIZE
+        if aligned:
+            self.__decryptBlocks(data[:aligned])
+        self.__carry += data[aligned:]
+
+    def Finalize(self):
+        if self.__carry:
+            raise Exception("Segment size is not a multiple of the AES block size.")
+        if not self.__tail:
+            return
+        padding = self.__tail[-1]
+        if padding < 1 or padding > SegmentDecryptor.__BLOCK_SIZE or self.__tail[-padding:] != bytes([padding]) * padding:
+            raise Exception("Invalid PKCS7 padding.")
+        self.__output.write(self.__tail[:-padding])
+
+    def __decryptBlocks(self, blocks):
+        # The last block is held back until the next call, since it may hold the padding.
+        step = len(self.__buffer)
+        for start in range(0, len(blocks), step):
+            chunk = blocks[start:start + step]
+            plain = memoryview(self.__buffer)[:len(chunk)]
+            self.__aes.decrypt(chunk, output=plain)
+            if self.__tail:
+                self.__output.write(self.__tail)
+            self.__output.write(plain[:-SegmentDecryptor.__BLOCK_SIZE])
+            self.__tail[:] = plain[-SegmentDecryptor.__BLOCK_SIZE:]
+
+class SegmentCopier:
+    """Same interface as SegmentDecryptor, for segments stored in clear."""
+    def __init__(self, output):
+        self.__output = output
+
+    def Update(self, data):
+        self.__output.write(data)
+
+    def Finalize(self):
         pass
 
-    def DecryptFile(self, file_path):
-        key = None
-        iv = None
-        decrypted = None
+class TsValidator:
+    """Write-through check that a decrypted segment is made of whole MPEG-TS packets starting with the sync byte.
+
+    A wrong key or IV, or a corrupted segment, almost never survives it.
+    """
+    PACKET_SIZE = 188
+    SYNC_BYTE = b'\x47'
+
+    def __init__(self, output=None, name='Segment'):
+        self.__output = output
+        self.__name = name
+        self.__offset = 0
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        sync = view[-self.__offset % TsValidator.PACKET_SIZE::TsValidator.PACKET_SIZE].tobytes()
+        if sync.count(TsValidator.SYNC_BYTE) != len(sync):
+            position = next(i for i, x in enumerate(sync) if x != TsValidator.SYNC_BYTE[0])
+            offset = self.__offset + (-self.__offset % TsValidator.PACKET_SIZE) + position * TsValidator.PACKET_SIZE
+            raise Exception("{} is not a valid MPEG-TS stream: sync byte missing at offset {}.".format(self.__name, offset))
+        self.__offset += len(view)
+        if self.__output is not None:
+            self.__output.write(data)
+
+    def Finalize(self):
+        if self.__offset % TsValidator.PACKET_SIZE:
+            raise Exception("{} is not a valid MPEG-TS stream: {} bytes are not a whole number of packets.".format(self.__name, self.__offset))
+
+def ValidateTs(data, name):
+    validator = TsValidator(name=name)
+    validator.write(data)
+    validator.Finalize()
+
+def CreateDecryptor(key, iv, output, buffer):
+    if key is None:
+        return SegmentCopier(output)
+    return SegmentDecryptor(key, iv, output, buffer)
+
+def ParseIV(text):
+    """IVs are stored as in the playlist, an hexadecimal string starting with 0x."""
+    return bytes(bytearray.fromhex(text[2::]))
+
+class Decrypt:
+    __CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, chunk_size=None, validate=True):
+        chunk_size = chunk_size or Decrypt.__CHUNK_SIZE
+        self.validate = validate
+        self.__input = bytearray(chunk_size)
+        self.__output = bytearray(chunk_size)
+
+    def LoadKeys(self, lesson_path):
+        """Map each segment to its key and IV.
+
+        keys.json holds a key and IV for every segment; lessons downloaded before it existed
+        have a single key.bin and iv.bin used for all the segments.
+        """
+        keys_path = os.path.join(lesson_path, 'keys.json')
+        if os.path.isfile(keys_path):
+            with open(keys_path, 'r') as k:
+                key_map = json.loads(k.read())
+            keys = {uri: bytes.fromhex(key) for uri, key in key_map['keys'].items()}
+            return {x['uri']: (keys.get(x['key']), x['iv'] and ParseIV(x['iv'])) for x in key_map['segments']}
+
+        key_path = os.path.join(lesson_path, 'key.bin')
+        iv_path = os.path.join(lesson_path, 'iv.bin')
 
-        path = os.path.dirname(file_path)
-        key_path = os.path.join(path, 'key.bin')
-        iv_path = os.path.join(path, 'iv.bin')
-         
         with open(key_path, 'rb') as k:
-            key = k.read()    
+            key = k.read()
         with open(iv_path, 'r') as i:
-            iv =bytes(bytearray.fromhex(i.read()[2::]))
+            iv = ParseIV(i.read())
+        return collections.defaultdict(lambda: (key, iv))
 
-        aes = AES.new(key, AES.MODE_CBC, iv)
+    def GetOutputPath(self, lesson_path):
+        """Decrypted file in a lesson folder follow the convention lesson_id.decrypted."""
+        decrypted_path = os.path.join(lesson_path, lesson_path.rsplit('/',1)[1])
+        return decrypted_path + '.decrypted'
 
-        with open(file_path, 'rb') as d:
-                decrypted = aes.decrypt(d.read())
-        return decrypted
+    def DecryptFile(self, file_path, key, iv, output):
+        """Decrypt a segment into output, returning the number of bytes read."""
+        decryptor = CreateDecryptor(key, iv, output, self.__output)
+        view = memoryview(self.__input)
+        size = 0
+        with open(file_path, 'rb', buffering=0) as d:
+            while True:
+                read = d.readinto(self.__input)
+                if not read:
+                    break
+                decryptor.Update(view[:read])
+                size += read
+        decryptor.Finalize()
+        return size
 
-    def Initialize(self, lesson_path):
-        decrypted_path = os.path.join(lesson_path, lesson_path.rsplit('/',1)[1])
-        decrypted_path = decrypted_path + '.decrypted'
+    def DecryptLesson(self, lesson_path, segments, progress=None):
+        """Decrypt the segments of a lesson, in the given order, into the lesson's decrypted file.
 
-        with open(decrypted_path, 'w') as o:
-            pass
+        Returns the number of bytes decrypted."""
+        if not segments:
+            # Lessons downloaded with inline decryption have no encrypted segments to process.
+            return 0
+        # Written aside and renamed at the end, so a segment failing validation leaves no truncated file.
+        output_path = self.GetOutputPath(lesson_path)
+        temp_path = output_path + '.part'
+        try:
+            with open(temp_path, 'wb') as output:
+                size = self.DecryptSegments(lesson_path, segments, output, progress)
+        except:
+            os.remove(temp_path)
+            raise
+        os.replace(temp_path, output_path)
+        return size
 
-    def ProcessFile(self, file_path):
-        decrypted = self.DecryptFile(file_path)
-        parent = os.path.dirname(file_path)
-        decrypted_path = os.path.join(parent, parent.rsplit('/',1)[1])
-        decrypted_path = decrypted_path + '.decrypted'
+    def DecryptSegments(self, lesson_path, segments, output, progress=None):
+        """Decrypt the segments of a lesson, in the given order, into an open binary stream."""
+        keys = self.LoadKeys(lesson_path)
+        size = 0
+        for segment in segments:
+            key, iv = keys[segment]
+            segment_path = os.path.join(lesson_path, segment)
+            if not self.validate:
+                size += self.DecryptFile(segment_path, key, iv, output)
+            else:
+                validator = TsValidator(output, segment_path)
+                size += self.DecryptFile(segment_path, key, iv, validator)
+                validator.Finalize()
+            if progress is not None:
+                progress.next()
+        return size
 
-        with open(decrypted_path, 'ab') as o:
-                o.write(decrypted)
 
+def ListSegments(lesson_path):
+    """Encrypted segments of a lesson, in playlist order."""
+    return scan.Lesson(lesson_path).GetSegments()
 
-if __name__ == '__main__':
-    decrypt = Decrypt()
-    trainers = [x for x in os.listdir('./download') if os.path.isdir(os.path.join('./download',x))]
-    for index, trainer in enumerate(trainers):
-        print("Start processing trainer {}/{}: {}.".format(index+1, len(trainers), trainer))
-        trainer_path = os.path.join('./download', trainer)
-        courses = [x for x in os.listdir(trainer_path) if os.path.isdir(os.path.join(trainer_path, x))]
-        for index,course in enumerate(courses):
-            print("Start processing course {}/{}: {}.".format(index+1, len(trainers), course))
-            course_path = os.path.join(trainer_path, course)
-            lessons = [x for x in os.listdir(course_path) if os.path.isdir(os.path.join(course_path, x))]
-            for index, lesson in enumerate(lessons):
-                lesson_path = os.path.join(course_path, lesson)
-                segments = [x for x in os.listdir(lesson_path) if os.path.isfile(os.path.join(lesson_path,x)) and x.endswith('.ts')]
-                segments.sort(key=lambda x: int(x[x.find('segment')+len('segment'): x.rfind('.'):]))
-                segment_bar = ChargingBar("Processing lesson {}/{}:".format(index+1, len(lessons)), max=len(segments), suffix='%(index)d/%(max)d - ETA %(eta)ds')
-                decrypt.Initialize(lesson_path)
-                for segment in segments:
-                    segment_path = os.path.join(lesson_path, segment)
-                    decrypt.ProcessFile(segment_path)
-                    segment_bar.next()
-            print('\n')
+def ListLessons(root):
+    return [x.path for x in scan.Tree(root).GetLessons()]
+
+@contextlib.contextmanager
+def OpenManifest(root):
+    """Manifest of the downloader, None for trees downloaded before it existed."""
+    manifest_path = os.path.join(root, 'manifest.db')
+    if not os.path.isfile(manifest_path):
+        yield None
+        return
+    manifest = Manifest(manifest_path)
+    try:
+        yield manifest
+    finally:
+        manifest.Close()
+
+def ShouldDecrypt(lesson, manifest):
+    """Lessons are decrypted once completely downloaded, unless their decrypted file is already up to date.
+
+    Lessons the manifest doesn't mark complete, or with only part of their segments on disk, are
+    skipped with a message: the next download completes them.
+    """
+    if manifest is not None and not manifest.IsLessonComplete(lesson.id):
+        print("✕ Lesson {} skipped: its download is not complete.".format(lesson.path))
+        return False
+    if not lesson.IsComplete():
+        print("✕ Lesson {} skipped: {} segments are missing.".format(lesson.path, len(lesson.GetMissingSegments())))
+        return False
+    return not lesson.IsDecrypted()
+
+def RecordLesson(size, seconds):
+    """Account a decrypted lesson in the metrics of this process."""
+    metrics.registry.Increment('hls_decrypt_bytes_total', size)
+    metrics.registry.Increment('hls_decrypt_seconds_total', seconds)
+    metrics.registry.Observe('hls_decrypt_lesson_seconds', seconds)
+    if seconds > 0:
+        metrics.registry.SetGauge('hls_decrypt_bytes_per_second', size / seconds)
+
+def DecryptLessonJob(lesson_path, validate=True, segments=None):
+    """Entry point for the worker processes: each lesson produces its own decrypted file.
 
+    Size and time are returned, since the metrics of the worker processes aren't exported."""
+    start = time.monotonic()
+    if segments is None:
+        segments = ListSegments(lesson_path)
+    size = Decrypt(validate=validate).DecryptLesson(lesson_path, segments)
+    return lesson_path, size, time.monotonic() - start
+
+def DecryptParallel(root, jobs, validate=True, interval=None):
+    with OpenManifest(root) as manifest:
+        lessons = [x for x in scan.Tree(root).GetLessons() if ShouldDecrypt(x, manifest)]
+    if interval is None:
+        lesson_bar = ChargingBar("Processing lessons:", max=len(lessons), suffix='%(index)d/%(max)d - ETA %(eta)ds')
+    else:
+        lesson_bar = scan.ProgressLine("Lessons decrypted:", len(lessons), interval)
+    decrypted = 0
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(DecryptLessonJob, x.path, validate, x.GetSegments()): x for x in lessons}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                _, size, seconds = future.result()
+                decrypted += 1
+                RecordLesson(size, seconds)
+            except Exception as e:
+                failed += 1
+                PrintFailure(futures[future], e)
+            lesson_bar.next()
+    lesson_bar.finish()
+    if interval is None:
+        print('\n')
+    PrintSummary(decrypted, failed)
+
+def PrintFailure(lesson, error):
+    print("✕ Lesson {} failed: {}".format(lesson.path, error))
+
+def PrintSummary(decrypted, failed):
+    print("{} lessons decrypted, {} failed.".format(decrypted, failed))
+
+def DecryptSerial(root, validate=True, interval=None):
+    """Decrypt the lessons one after the other; a lesson failing is reported and the others still decrypted."""
+    decrypt = Decrypt(validate=validate)
+    tree = scan.Tree(root)
+    decrypted = 0
+    failed = 0
+    def decryptLesson(lesson, segments, progress):
+        nonlocal decrypted, failed
+        start = time.monotonic()
+        try:
+            size = decrypt.DecryptLesson(lesson.path, segments, progress)
+        except Exception as e:
+            failed += 1
+            PrintFailure(lesson, e)
+            return
+        decrypted += 1
+        RecordLesson(size, time.monotonic() - start)
+
+    with OpenManifest(root) as manifest:
+        if interval is not None:
+            lessons = [x for x in tree.GetLessons() if ShouldDecrypt(x, manifest)]
+            segment_bar = scan.ProgressLine("Segments decrypted:", sum(len(x.GetSegments()) for x in lessons), interval)
+            for lesson in lessons:
+                decryptLesson(lesson, lesson.GetSegments(), segment_bar)
+            segment_bar.finish()
+            PrintSummary(decrypted, failed)
+            return
+
+        trainers = list(tree.trainers)
+        for index, trainer in enumerate(trainers):
+            print("Start processing trainer {}/{}: {}.".format(index+1, len(trainers), trainer))
+            courses = list(tree.trainers[trainer])
+            for index,course in enumerate(courses):
+                print("Start processing course {}/{}: {}.".format(index+1, len(courses), course))
+                lessons = tree.trainers[trainer][course]
+                for index, lesson_id in enumerate(lessons):
+                    lesson = tree.GetLesson(trainer, course, lesson_id)
+                    if not ShouldDecrypt(lesson, manifest):
+                        continue
+                    segments = lesson.GetSegments()
+                    segment_bar = ChargingBar("Processing lesson {}/{}:".format(index+1, len(lessons)), max=len(segments), suffix='%(index)d/%(max)d - ETA %(eta)ds')
+                    decryptLesson(lesson, segments, segment_bar)
+                print('\n')
+    PrintSummary(decrypted, failed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=1, help='Number of lessons decrypted in parallel by separate processes.')
+    parser.add_argument('--no-validate', action='store_true', help='Skip the check that decrypted segments are valid MPEG-TS.')
+    parser.add_argument('--progress-interval', type=float, default=None, help='Print a progress line every N seconds instead of redrawing progress bars; 0 prints only the final line.')
+    metrics.AddArguments(parser)
+    args = parser.parse_args()
 
+    with metrics.Collect(args):
+        if args.jobs > 1:
+            DecryptParallel('./download', args.jobs, not args.no_validate, args.progress_interval)
+        else:
+            DecryptSerial('./download', not args.no_validate, args.progress_interval)
@@ -1,12 +1,28 @@
 #!/usr/bin/env python3
 import requests
+import requests.adapters
 import json
+import io
+import hashlib
 import logging
 import m3u8
 import pprint
 import urllib.parse
 import os.path
+import argparse
+import concurrent.futures
+import collections
+import threading
+import time
+import random
+import datetime
 from progress.bar import ChargingBar
+import decrypt
+from manifest import Manifest
+from cache import ResponseCache
+from throttle import BandwidthLimiter, ConcurrencyController
+from store import SegmentStore
+import metrics
 
 class Trainer:
     def __init__(self, uri, uuid):
@@ -30,10 +46,14 @@ class Lesson:
         self.video = None
         self.master = None
         self.best_stream = None
-        self.segments = None 
+        self.segments = None
+        self.keys = None
+        self.request = None
 
-class AESKey:
-    def __init__(self, key, iv):
+class SegmentKey:
+    def __init__(self, uri, key_uri, key, iv):
+        self.uri = uri
+        self.key_uri = key_uri
         self.key = key
         self.iv = iv
 
@@ -59,11 +79,110 @@ class BrowserMock:
         except:
             raise Exception("Cookies not found.")
 
+class HttpClient:
+    """Keep-alive HTTP session shared by every request of a download run."""
+    def __init__(self, pool_size=8, connect_timeout=10, read_timeout=60, cache=None, max_in_flight=None, limiter=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache = cache
+        self.limiter = limiter
+        self.requests = 0
+        self.__lock = threading.Lock()
+        self.__in_flight = threading.BoundedSemaphore(max_in_flight or pool_size)
+        self.__adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        self.__session = requests.Session()
+        self.__session.mount('http://', self.__adapter)
+        self.__session.mount('https://', self.__adapter)
+
+    def Get(self, uri, params=None, headers=None, stream=False, endpoint=None):
+        """GET uri; the time to the response headers is observed per endpoint, the class issuing the request."""
+        with self.__lock:
+            self.requests += 1
+        endpoint = endpoint or 'Other'
+        # Bounds the requests in flight across segment workers and lesson resolvers.
+        self.__in_flight.acquire()
+        try:
+            with metrics.registry.Time('hls_request_seconds', endpoint=endpoint):
+                response = self.__session.get(uri, params=params, headers=headers, timeout=self.timeout, stream=stream)
+        except BaseException as e:
+            self.__in_flight.release()
+            if isinstance(e, requests.exceptions.RequestException):
+                metrics.registry.Increment('hls_requests_total', endpoint=endpoint, status='error')
+            raise
+        metrics.registry.Increment('hls_requests_total', endpoint=endpoint, status=response.status_code)
+        if stream:
+            self.__releaseOnClose(response)
+        else:
+            self.__in_flight.release()
+        return response
+
+    def __releaseOnClose(self, response):
+        """A streamed body keeps its connection busy until it is read or closed, and so its slot."""
+        close = response.close
+        released = False
+        def release():
+            nonlocal released
+            try:
+                close()
+            finally:
+                with self.__lock:
+                    if released:
+                        return
+                    released = True
+                self.__in_flight.release()
+        response.close = release
+
+    def IterContent(self, response, chunk_size):
+        """Body of a streamed response, throttled by the bandwidth limiter. The response is closed at the end."""
+        host = urllib.parse.urlparse(response.url).netloc
+        try:
+            for chunk in response.iter_content(chunk_size):
+                if self.limiter is not None:
+                    self.limiter.Consume(host, len(chunk))
+                metrics.registry.Increment('hls_segment_bytes_total', len(chunk))
+                yield chunk
+        finally:
+            response.close()
+
+    def GetJson(self, uri, params=None, headers=None, ttl=None, endpoint=None):
+        """Decoded JSON body, served from the cache while fresh and revalidated once stale."""
+        if self.cache is None:
+            response = self.Get(uri, params=params, headers=headers, endpoint=endpoint)
+            response.raise_for_status()
+            return response.json()
+
+        entry = self.cache.Load(uri, params)
+        if entry is not None and self.cache.IsFresh(entry, ttl):
+            metrics.registry.Increment('hls_cache_total', endpoint=endpoint, result='hit')
+            return entry['body']
+
+        headers = dict(headers or {})
+        if entry is not None:
+            headers.update(self.cache.GetValidators(entry))
+        response = self.Get(uri, params=params, headers=headers, endpoint=endpoint)
+        if entry is not None and response.status_code == 304:
+            metrics.registry.Increment('hls_cache_total', endpoint=endpoint, result='revalidated')
+            self.cache.Refresh(uri, params, entry)
+            return entry['body']
+        metrics.registry.Increment('hls_cache_total', endpoint=endpoint, result='miss')
+        response.raise_for_status()
+        body = response.json()
+        self.cache.Store(uri, params, body, response.headers)
+        return body
+
+    def GetConnectionCount(self):
+        """Number of TCP connections opened by the pools currently alive."""
+        pools = self.__adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def Close(self):
+        self.__session.close()
+
 class TrainerRequest:
-    def __init__(self, uri, uuid):
+    def __init__(self, uri, uuid, client):
         self.response = None
         self.uuid = uuid
         self.uri = uri
+        self.client = client
         self.courses = []
         self.__browser = BrowserMock()
         self.__headers = self.__browser.GetCommonHeaders()
@@ -72,20 +191,19 @@ class TrainerRequest:
         if self.response is None:
             parameters = { 'trainer_id' : self.uuid }
             uri = os.path.join(self.uri, "api", "courses")
-            trainer_req = requests.get(uri, params=parameters, headers=self.__headers)
-            trainer_req.raise_for_status()
+            self.response = self.client.GetJson(uri, params=parameters, headers=self.__headers, endpoint='TrainerRequest')
             logging.debug("Request for trainer with id {} successful.".format(self.uuid))
-            self.response = trainer_req.json()
         return self.response
 
     def GetCourseRequests(self):
-        return [CourseRequest(self.uri, x['id']) for x in self.response['data']['courses']]
+        return [CourseRequest(self.uri, x['id'], self.client) for x in self.response['data']['courses']]
 
 class CourseRequest:
-    def __init__(self, uri, uuid):
+    def __init__(self, uri, uuid, client):
         self.response = None
         self.uuid = uuid
         self.uri = uri
+        self.client = client
         self.__browser = BrowserMock()
         self.__headers = self.__browser.GetCommonHeaders()
 
@@ -93,41 +211,40 @@ class CourseRequest:
         if self.response is None:
             parameters = { 'course_id' : self.uuid }
             uri = os.path.join(self.uri, "api", "course")
-            course_req = requests.get(uri, params=parameters, headers=self.__headers)
-            course_req.raise_for_status()
+            self.response = self.client.GetJson(uri, params=parameters, headers=self.__headers, endpoint='CourseRequest')
             logging.debug("Request for course with id {} successful.".format(self.uuid))
-            self.response = course_req.json()
         return self.response
 
     def GetLessonRequests(self):
-        return [LessonRequest(self.uri, x['id']) for x in self.response['data']['lessons']]
+        return [LessonRequest(self.uri, x['id'], self.client) for x in self.response['data']['lessons']]
 
 class LessonRequest:
-    def __init__(self, uri, uuid):
+    def __init__(self, uri, uuid, client):
         self.response = None
         self.browser = BrowserMock()
         self.uuid = uuid 
         self.uri = uri
+        self.client = client
         self.__headers = self.browser.GetCommonHeaders()
 
     def DoRequest(self):
         if self.response is None:
             parameters = { "lesson_id" : self.uuid }
             uri = os.path.join(self.uri, "api", "video")
-            video_req = requests.get(uri, params=parameters, headers=self.__headers)
-            video_req.raise_for_status()
+            # The video response carries the token for the playlists, so it's always revalidated.
+            self.response = self.client.GetJson(uri, params=parameters, headers=self.__headers, ttl=0, endpoint='LessonRequest')
             logging.debug("Request for video with id {} successful.".format(self.uuid))
-            self.response = video_req.json()
         return self.response
 
     def GetMasterRequest(self):
-        parameters = self.__getParameters()
+        parameters = self.GetParameters()
         master_name = self.__getMasterName()
         base_address = self.__getBaseAddress()
         uuid = master_name.rsplit('/', 2)[1]
-        return MasterRequest(base_address, uuid, parameters, master_name)
+        return MasterRequest(base_address, uuid, parameters, master_name, self.client)
 
-    def __getParameters(self):
+    def GetParameters(self):
+        """Query string with the token authorizing the playlists, keys and segments of the video."""
         return self.response['data']['token']['token_querystring']
  
     def __getMasterName(self):
@@ -137,89 +254,190 @@ class LessonRequest:
         parsed = urllib.parse.urlparse(self.response['data']['token']['url'])
         return parsed.scheme + '://' + parsed.netloc + '/'
 
+class VariantPolicy:
+    """Chooses which variant of a master playlist is downloaded.
+
+    Variants above max_bandwidth (bits per second) or max_height (pixels) are discarded; if none
+    is left the one with the lowest bandwidth is taken. Among the remaining variants the ones whose
+    CODECS start with the earliest of the preferred codecs win, then the highest bandwidth.
+    """
+    def __init__(self, max_bandwidth=None, max_height=None, codecs=None):
+        self.max_bandwidth = max_bandwidth
+        self.max_height = max_height
+        self.codecs = codecs or []
+
+    def Choose(self, playlists):
+        allowed = [x for x in playlists if self.__isAllowed(x.stream_info)]
+        if not allowed:
+            return min(playlists, key = lambda p: p.stream_info.bandwidth)
+        return min(allowed, key = lambda p: (self.__getCodecRank(p.stream_info), -p.stream_info.bandwidth))
+
+    def __isAllowed(self, stream_info):
+        if self.max_bandwidth is not None and stream_info.bandwidth > self.max_bandwidth:
+            return False
+        if self.max_height is not None and stream_info.resolution is not None and stream_info.resolution[1] > self.max_height:
+            return False
+        return True
+
+    def __getCodecRank(self, stream_info):
+        codecs = [x.strip() for x in (stream_info.codecs or '').split(',')]
+        for rank, preferred in enumerate(self.codecs):
+            if any(x.startswith(preferred) for x in codecs):
+                return rank
+        return len(self.codecs)
+
 class MasterRequest:
-    def __init__(self, uri, uuid, parameters, master_name):
+    def __init__(self, uri, uuid, parameters, master_name, client):
         self.response = None
         self.uri = uri
         self.uuid = uuid
         self.parameters = parameters
         self.master_name = master_name
+        self.client = client
 
     def DoRequest(self):
         if self.response is None:
-            master_req = requests.get(self.master_name, params=self.parameters)
+            master_req = self.client.Get(self.master_name, params=self.parameters, endpoint='MasterRequest')
             master_req.raise_for_status()
             logging.debug("Request for master M3U8 with id {} successful.".format(self.uuid))
             self.response = master_req
             logging.debug(self.response)
         return self.response
 
-    def GetBestStreamRequest(self):
-       best_stream_name = self.__getMaximumBitrateSegment()
-       return BestStreamRequest(self.uri, self.uuid, self.parameters, best_stream_name)
+    def GetBestStreamRequest(self, policy=None):
+        """Request for the variant chosen by the policy.
 
-    def __getMaximumBitrateSegment(self):
+        If the master is already a media playlist, the returned request reuses its response.
+        """
         playlist = m3u8.loads(self.response.text)
         logging.debug('Parsing of Master M3U3 for id {} successful.'.format(self.uuid))
 
-        if len(playlist.playlists) <= 1:
-            raise Exception("This is not a variant playlist!")
+        if not playlist.is_variant:
+            if not playlist.segments:
+                raise Exception("Playlist for video with id {} has neither variants nor segments!".format(self.uuid))
+            logging.debug("Playlist for video with id {} is a media playlist.".format(self.uuid))
+            best_stream = BestStreamRequest(self.uri, self.uuid, self.parameters, self.master_name.rsplit('/', 1)[1], self.client)
+            best_stream.response = self.response
+            return best_stream
 
-        max_bitrate = max(playlist.playlists, key = lambda p: p.stream_info.bandwidth)
-        logging.debug("The chosen bitrate for video with id {} is {}.".format(self.uuid, max_bitrate.stream_info.bandwidth))
-        return max_bitrate.uri
+        variant = (policy or VariantPolicy()).Choose(playlist.playlists)
+        logging.debug("The chosen bitrate for video with id {} is {}.".format(self.uuid, variant.stream_info.bandwidth))
+        bandwidth = variant.stream_info.average_bandwidth or variant.stream_info.bandwidth
+        return BestStreamRequest(self.uri, self.uuid, self.parameters, variant.uri, self.client, bandwidth)
 
 class BestStreamRequest:
-    def __init__(self, uri, uuid, parameters, best_stream_name):
+    def __init__(self, uri, uuid, parameters, best_stream_name, client, bandwidth=None):
         self.response = None
         self.uuid = uuid
         self.parameters = parameters
         self.uri = uri
         self.best_stream_name = best_stream_name
-        self.key = None
+        self.client = client
+        self.bandwidth = bandwidth
+        self.keys = None
 
     def DoRequest(self):
         if self.response is None:
             uri = os.path.join(self.uri, self.uuid, self.best_stream_name)
-            best_stream_req = requests.get(uri, params = self.parameters)
+            best_stream_req = self.client.Get(uri, params = self.parameters, endpoint='BestStreamRequest')
             best_stream_req.raise_for_status()
             logging.debug("Request for best stream with id {} successful.".format(self.uuid))
             self.response = best_stream_req
             logging.debug(self.response)
         return self.response
 
-    def GetKey(self):
-        if self.key is None:
+    def GetKeys(self):
+        """Key and IV of every segment, in playlist order. Each key is fetched once.
+
+        When EXT-X-KEY has no IV the media sequence number of the segment is used, as per the HLS spec.
+        """
+        if self.keys is None:
             playlist = m3u8.loads(self.response.text)
-            if len(playlist.keys) != 1:
-                raise Exception("Wrong number of keys detected {}".format(len(playlist.keys)))
-            key = playlist.keys[0]
-            uri = os.path.join(self.uri, self.uuid, key.uri)
-            key_req = requests.get(uri, params=self.parameters)
-            self.key = AESKey(key_req.content, key.iv)
-        return self.key
+            sequence = playlist.media_sequence or 0
+            fetched = {}
+            # Assigned only once every key is fetched, so that a retry after a failure starts over.
+            keys = []
+            for index, segment in enumerate(playlist.segments):
+                key = segment.key
+                if key is None or key.method == 'NONE':
+                    keys.append(SegmentKey(segment.uri, None, None, None))
+                    continue
+                if key.method != 'AES-128':
+                    raise Exception("Unsupported encryption method {} for video with id {}".format(key.method, self.uuid))
+                if key.uri not in fetched:
+                    fetched[key.uri] = self.__getKey(key.uri)
+                iv = key.iv or '0x{:032x}'.format(sequence + index)
+                keys.append(SegmentKey(segment.uri, key.uri, fetched[key.uri], iv))
+            self.keys = keys
+            logging.debug("{} keys found for video with id {}.".format(len(fetched), self.uuid))
+        return self.keys
+
+    def __getKey(self, key_uri):
+        uri = os.path.join(self.uri, self.uuid, key_uri)
+        key_req = self.client.Get(uri, params=self.parameters, endpoint='KeyRequest')
+        key_req.raise_for_status()
+        return key_req.content
+
+    def GetDuration(self):
+        playlist = m3u8.loads(self.response.text)
+        return sum(x.duration or 0 for x in playlist.segments)
+
+    def EstimateSize(self):
+        """Bytes the segments are expected to take, None if unknown.
+
+        Exact when every segment has an EXT-X-BYTERANGE, otherwise bandwidth times duration.
+        """
+        playlist = m3u8.loads(self.response.text)
+        if playlist.segments and all(x.byterange for x in playlist.segments):
+            return sum(int(x.byterange.split('@')[0]) for x in playlist.segments)
+        if self.bandwidth is None:
+            return None
+        return int(self.bandwidth * self.GetDuration() / 8)
 
     def GetSegmentRequests(self):
         playlist = m3u8.loads(self.response.text)
-        return [SegmentRequest(self.uri, self.uuid, self.parameters, x) for x in playlist.segments]
+        return [SegmentRequest(self.uri, self.uuid, self.parameters, x, self.client) for x in playlist.segments]
 
 class SegmentRequest:
-    def __init__(self, uri, uuid, parameters, segment):
+    def __init__(self, uri, uuid, parameters, segment, client):
         self.response = None
         self.uuid = uuid
         self.parameters = parameters
         self.uri = uri
         self.segment = segment
+        self.client = client
 
-    def DoRequest(self):
+    def DoRequest(self, offset=0):
+        """Request the segment body starting at offset; the server answers 206 if it honours the range."""
         if self.response is None:
             uri = os.path.join(self.uri, self.uuid, self.segment.uri)
-            segment_req = requests.get(uri, params = self.parameters)
-            segment_req.raise_for_status()
+            headers = {'range': 'bytes={}-'.format(offset)} if offset else None
+            segment_req = self.client.Get(uri, params = self.parameters, headers=headers, stream=True, endpoint='SegmentRequest')
+            try:
+                segment_req.raise_for_status()
+            except requests.exceptions.HTTPError:
+                # Streamed responses hold their pooled connection until closed.
+                segment_req.close()
+                raise
             logging.debug("Request for segment {} of video with id {} successful.".format(self.segment.uri, self.uuid))
             self.response = segment_req
         return self.response
 
+class IncompleteSegment(Exception):
+    pass
+
+class TokenExpired(Exception):
+    pass
+
+def IsForbidden(error):
+    return isinstance(error, requests.exceptions.HTTPError) and error.response is not None and error.response.status_code == 403
+
+def CheckContentLength(response, length, description):
+    """Raise IncompleteSegment if fewer bytes than announced by the server were received."""
+    expected = response.headers.get('content-length')
+    if expected is not None and 'content-encoding' not in response.headers and int(expected) != length:
+        raise IncompleteSegment("{} is truncated: {}/{} bytes.".format(description, length, expected))
+
 class Container:
     def __init__(self, uuid, root='./'):
         self.uuid = uuid
@@ -241,57 +459,202 @@ class Container:
         with open(path, 'w') as s:
             s.write(json.dumps(meta, indent=4))
 
+class SegmentReassembler:
+    """Writes segments completed in any order to the output in playlist order."""
+    def __init__(self, output):
+        self.output = output
+        self.next = 0
+        self.__pending = {}
+
+    def Add(self, index, data):
+        self.__pending[index] = data
+        while self.next in self.__pending:
+            self.output.write(self.__pending.pop(self.next))
+            self.next += 1
+
 class LessonContainer:
-    def __init__(self, uuid, root = './'):
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, uuid, root = './', store=None):
         self.uuid = uuid
         self.root = root
         self.path = os.path.join(root, uuid)
+        self.store = store
 
         if not os.path.isdir(self.path):
             os.mkdir(self.path)
 
-    def IsSegmentDownloaded(self, segment):
+    def GetSegmentSize(self, segment):
         path = os.path.join(self.root, self.uuid, segment.uri)
-        return os.path.isfile(path)
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return None
 
     def WriteMetadata(self, meta):
         path = os.path.join(self.root, self.uuid, "metadata.json")
         with open(path, 'w') as s:
             s.write(json.dumps(meta, indent=4))
 
-    def WriteSegment(self, segment, response):
+    def GetPartialSize(self, segment):
+        """Bytes of the segment received by an interrupted attempt."""
+        path = os.path.join(self.root, self.uuid, segment.uri + '.part')
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+    def DiscardPartial(self, segment):
+        path = os.path.join(self.root, self.uuid, segment.uri + '.part')
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def WriteSegment(self, segment, response, chunks, offset=0):
+        """Stream the body chunks of the segment response into a temporary file, renamed only once the body is complete.
+
+        With an offset the chunks are appended to the bytes received by a previous attempt.
+        Returns length and SHA-256 of the segment.
+        """
+        path = os.path.join(self.root, self.uuid, segment.uri)
+        temp_path = path + '.part'
+        length = offset
+        checksum = hashlib.sha256()
+        if offset:
+            with open(temp_path, 'rb') as s:
+                for chunk in iter(lambda: s.read(LessonContainer.CHUNK_SIZE), b''):
+                    checksum.update(chunk)
+        try:
+            with open(temp_path, 'ab' if offset else 'wb') as s:
+                for chunk in chunks:
+                    s.write(chunk)
+                    length += len(chunk)
+                    checksum.update(chunk)
+        finally:
+            response.close()
+        CheckContentLength(response, length - offset, "Segment {} of video with id {}".format(segment.uri, self.uuid))
+        checksum = checksum.hexdigest()
+        if self.store is not None:
+            self.store.Add(temp_path, path, checksum)
+        else:
+            os.replace(temp_path, path)
+        logging.debug("Write segment {} of video with id {} successful.".format(segment.uri, self.uuid))
+        return length, checksum
+
+    def ReadSegment(self, segment):
         path = os.path.join(self.root, self.uuid, segment.uri)
-        with open(path, 'wb') as s:
-            s.write(response.content)
-            logging.debug("Write segment {} of video with id {} successful.".format(segment.uri, self.uuid))
-
-    def WriteKey(self, key):
-        key_path = os.path.join(self.root, self.uuid, "key.bin")
-        iv_path = os.path.join(self.root, self.uuid, "iv.bin")
-        with open(key_path, 'wb') as k:
-            k.write(key.key)
-        with open(iv_path, 'w') as i:
-            i.write(key.iv)
+        with open(path, 'rb') as s:
+            for chunk in iter(lambda: s.read(LessonContainer.CHUNK_SIZE), b''):
+                yield chunk
+
+    def GetDecryptedPath(self):
+        return os.path.join(self.root, self.uuid, self.uuid + '.decrypted')
+
+    def IsDecrypted(self):
+        return os.path.isfile(self.GetDecryptedPath())
+
+    def WriteKeys(self, keys):
+        path = os.path.join(self.root, self.uuid, "keys.json")
+        key_map = {
+            'keys': {x.key_uri: x.key.hex() for x in keys if x.key is not None},
+            'segments': [{'uri': x.uri, 'key': x.key_uri, 'iv': x.iv} for x in keys]
+        }
+        with open(path, 'w') as k:
+            k.write(json.dumps(key_map, indent=4))
 
     
+class PendingCourse:
+    """A course with the lessons, as (index, LessonRequest), still to be downloaded.
+
+    A partial course leaves out some of them, so it isn't complete once they are downloaded.
+    """
+    def __init__(self, trainer_id, index, total, course, digest, container, lessons, partial=False):
+        self.trainer_id = trainer_id
+        self.index = index
+        self.total = total
+        self.course = course
+        self.digest = digest
+        self.container = container
+        self.lessons = lessons
+        self.partial = partial
+        self.failed = False
+
+def FormatSize(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} TiB".format(size)
+
+class PlanTotal:
+    """Estimated bytes and seconds of a group of lessons; lessons whose size couldn't be estimated are counted apart."""
+    def __init__(self):
+        self.lessons = 0
+        self.size = 0
+        self.duration = 0
+        self.unknown = 0
+
+    def Add(self, size, duration):
+        self.lessons += 1
+        self.duration += duration or 0
+        if size is None:
+            self.unknown += 1
+        else:
+            self.size += size
+
+    def Merge(self, other):
+        self.lessons += other.lessons
+        self.size += other.size
+        self.duration += other.duration
+        self.unknown += other.unknown
+
+    def __str__(self):
+        text = "{} lessons, {}, {}".format(self.lessons, datetime.timedelta(seconds=int(self.duration)), FormatSize(self.size))
+        if self.unknown:
+            text += " ({} of unknown size)".format(self.unknown)
+        return text
+
 class Downloader:
     __URI = "https://example.com/"
+    __ROOT = "./download/"
     __LOGGING_LEVEL = logging.INFO
 
-    def __init__(self):
+    def __init__(self, workers=8, connect_timeout=10, read_timeout=60, decrypt=False, verify=False, cache_ttl=24 * 60 * 60, resolvers=4, lookahead=8, max_in_flight=None,
+                 max_rate=None, max_host_rate=None, adaptive=False, retries=5, backoff=0.5, max_backoff=30, max_failures=10, policy=None, uri=None, store=True):
         logging.basicConfig(filename='downloader.log', level=Downloader.__LOGGING_LEVEL)
+        self.uri = uri or Downloader.__URI
+        self.workers = workers
+        self.policy = policy or VariantPolicy()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_failures = max_failures
+        self.failures = 0
+        self.controller = ConcurrencyController(workers, adaptive=adaptive)
+        self.queue_depth = 0
+        self.resolvers = resolvers
+        self.lookahead = lookahead
+        self.decrypt = decrypt
+        self.verify = verify
+        self.manifest = None
+        self.store = SegmentStore() if store else None
+        max_in_flight = max_in_flight or workers + resolvers
+        limiter = BandwidthLimiter(max_rate, max_host_rate)
+        self.client = HttpClient(workers + resolvers, connect_timeout, read_timeout, ResponseCache(ttl=cache_ttl), max_in_flight, limiter)
+        self.__executor = None
+        self.__on_lesson = None
+        self.__token_lock = threading.Lock()
 
     def DownloadTrainer(self, uuid):
-        request = TrainerRequest(Downloader.__URI, uuid)
-        response = request.DoRequest()
+        request = TrainerRequest(self.uri, uuid, self.client)
+        response = self.__retry(request.DoRequest, "Courses of trainer {}".format(uuid), segment=False)
 
-        trainer = Trainer(Downloader.__URI, uuid)
+        trainer = Trainer(self.uri, uuid)
         trainer.courses = request.GetCourseRequests()
         trainer.metadata = response
         return trainer
 
     def DownloadCourse(self, course_request):
-        response = course_request.DoRequest()
+        response = self.__retry(course_request.DoRequest, "Course {}".format(course_request.uuid), segment=False)
         lessons = course_request.GetLessonRequests()
 
         course = Course(course_request.uri, course_request.uuid)
@@ -300,53 +663,482 @@ class Downloader:
         return course
 
     def DownloadLessons(self, lesson_request):
+        with metrics.registry.Time('hls_lesson_resolve_seconds'):
+            # Each request of the chain keeps its response, so a retry resumes from the one that failed.
+            return self.__retry(lambda: self.__resolveLesson(lesson_request), "Resolution of lesson {}".format(lesson_request.uuid), segment=False)
+
+    def __resolveLesson(self, lesson_request):
         response = lesson_request.DoRequest()
-        master = lesson_request.GetMasterRequest()
+        try:
+            master = lesson_request.GetMasterRequest()
+
+            master.DoRequest()
+            best_stream = master.GetBestStreamRequest(self.policy)
 
-        master.DoRequest()
-        best_stream = master.GetBestStreamRequest()
+            best_stream.DoRequest()
+            segments = best_stream.GetSegmentRequests()
+            keys = best_stream.GetKeys()
+        except requests.exceptions.HTTPError as e:
+            if not IsForbidden(e):
+                raise
+            # The retry asks the video API for a new token and rebuilds the chain.
+            lesson_request.response = None
+            raise TokenExpired("Token of video with id {} expired.".format(lesson_request.uuid)) from e
 
-        best_stream.DoRequest()
-        segments = best_stream.GetSegmentRequests()
-        key = best_stream.GetKey() 
-        
         lesson = Lesson(lesson_request.uri, lesson_request.uuid)
+        lesson.request = lesson_request
         lesson.master = master
         lesson.best_stream = best_stream
         lesson.segments = segments
         lesson.metadata = response
-        lesson.key = key
+        lesson.keys = keys
         return lesson
 
+    def GetStats(self):
+        """Current segment throughput in bytes per second, concurrency limit and segments waiting to be requested."""
+        return {'rate': self.controller.rate, 'concurrency': self.controller.limit, 'queue_depth': self.queue_depth}
+
+    def DownloadSegments(self, lesson, lesson_container, segment_bar):
+        """Fetch the segments of a lesson keeping at most controller.limit requests in flight."""
+        completed = self.manifest.GetCompletedSegments(lesson.uuid)
+        pending = []
+        for segment in lesson.segments:
+            if self.__isSegmentComplete(segment.segment, completed, lesson_container):
+                segment_bar.next()
+            else:
+                pending.append(segment)
+        in_flight = set()
+        try:
+            for index, segment in enumerate(pending):
+                self.__setQueueDepth(len(pending) - index)
+                while len(in_flight) >= self.controller.limit:
+                    done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    self.__collectSegments(done, lesson, segment_bar)
+                in_flight.add(self.__executor.submit(self.__downloadSegment, lesson, segment, lesson_container))
+            self.__setQueueDepth(0)
+            self.__collectSegments(concurrent.futures.as_completed(in_flight), lesson, segment_bar)
+        except:
+            self.__cancel(in_flight)
+            raise
+
+    def __setQueueDepth(self, depth):
+        self.queue_depth = depth
+        metrics.registry.SetGauge('hls_segment_queue_depth', depth)
+
+    def __isSegmentComplete(self, segment, completed, lesson_container):
+        """Segments are trusted from the manifest; with verify their size on disk is checked as well."""
+        if segment.uri not in completed:
+            return False
+        if not self.verify:
+            return True
+        return lesson_container.GetSegmentSize(segment) == completed[segment.uri][0]
+
+    def __collectSegments(self, futures, lesson, segment_bar):
+        for future in futures:
+            uri, length, checksum = future.result()
+            self.manifest.MarkSegmentComplete(lesson.uuid, uri, length, checksum)
+            segment_bar.next()
+
+    def __cancel(self, in_flight):
+        """Drop the requests not started yet and wait for the running ones after a failure."""
+        for future in in_flight:
+            future.cancel()
+        concurrent.futures.wait(in_flight)
+        self.__setQueueDepth(0)
+
+    def __downloadSegment(self, lesson, segment, lesson_container):
+        def attempt():
+            start = time.monotonic()
+            offset = lesson_container.GetPartialSize(segment.segment)
+            try:
+                response = self.__requestSegment(lesson, segment, offset)
+            except requests.exceptions.HTTPError as e:
+                if offset and e.response is not None and e.response.status_code == 416:
+                    lesson_container.DiscardPartial(segment.segment)
+                raise
+            finally:
+                segment.response = None
+            if offset and response.status_code != 206:
+                offset = 0
+            chunks = self.client.IterContent(response, LessonContainer.CHUNK_SIZE)
+            length, checksum = lesson_container.WriteSegment(segment.segment, response, chunks, offset)
+            elapsed = time.monotonic() - start
+            self.controller.Record(length - offset, elapsed)
+            metrics.registry.Observe('hls_segment_seconds', elapsed)
+            return segment.segment.uri, length, checksum
+        return self.__retry(attempt, "Segment {} of video with id {}".format(segment.segment.uri, segment.uuid))
+
+    def __requestSegment(self, lesson, segment, offset):
+        """Request the segment from offset; on a 403 the token of the lesson is renewed for the retry."""
+        parameters = segment.parameters
+        try:
+            return segment.DoRequest(offset)
+        except requests.exceptions.HTTPError as e:
+            if not IsForbidden(e):
+                raise
+            self.__refreshToken(lesson, parameters)
+            raise TokenExpired("Token of video with id {} expired.".format(lesson.uuid)) from e
+
+    def __refreshToken(self, lesson, expired_parameters):
+        """Ask the video API for a new token and hand it to every request of the lesson.
+
+        Workers hitting the same expired token wait for the first one to renew it.
+        """
+        with self.__token_lock:
+            if lesson.best_stream.parameters != expired_parameters:
+                return
+            lesson.request.response = None
+            lesson.request.DoRequest()
+            parameters = lesson.request.GetParameters()
+            for request in [lesson.master, lesson.best_stream] + lesson.segments:
+                request.parameters = parameters
+            metrics.registry.Increment('hls_token_refreshes_total')
+            logging.info("Token of video with id {} renewed.".format(lesson.uuid))
+
+    def __retry(self, attempt, description, segment=True):
+        """Run attempt, retrying transient failures with exponential backoff and full jitter.
+
+        Only segment failures are reported to the concurrency controller, catalog and playlist
+        requests are retried the same way.
+        """
+        for retry in range(self.retries + 1):
+            try:
+                return attempt()
+            except Exception as e:
+                if retry == self.retries or not self.__isTransient(e):
+                    raise
+                if segment:
+                    # An expired token says nothing about the load on the server.
+                    if not isinstance(e, TokenExpired):
+                        self.controller.RecordError()
+                    metrics.registry.Increment('hls_segment_retries_total', error=type(e).__name__)
+                else:
+                    metrics.registry.Increment('hls_catalog_retries_total', error=type(e).__name__)
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
+                logging.warning("{} failed ({}), retrying in {:.1f}s.".format(description, e, delay))
+                time.sleep(delay)
+
+    def __isTransient(self, error):
+        if isinstance(error, requests.exceptions.HTTPError):
+            status = error.response.status_code if error.response is not None else None
+            return status is None or status >= 500 or status in (408, 416, 429)
+        return isinstance(error, (requests.exceptions.RequestException, IncompleteSegment, TokenExpired))
+
+    def DownloadDecryptedSegments(self, lesson, lesson_container, segment_bar):
+        """Decrypt segments as they arrive and write them in playlist order into the lesson's decrypted file.
+
+        Segments are never stored encrypted, unless they were already on disk from a previous run.
+        At most a window of segments past the first missing one is requested, bounding the memory
+        used by the reassembly buffer.
+        """
+        completed = self.manifest.GetCompletedSegments(lesson.uuid)
+        window = self.workers * 4
+        decrypted_path = lesson_container.GetDecryptedPath()
+        temp_path = decrypted_path + '.part'
+        with open(temp_path, 'wb') as output:
+            reassembler = SegmentReassembler(output)
+            in_flight = set()
+            try:
+                for index, segment in enumerate(lesson.segments):
+                    self.__setQueueDepth(len(lesson.segments) - index)
+                    while len(in_flight) >= self.controller.limit or index >= reassembler.next + window:
+                        done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                        self.__collectDecrypted(done, reassembler, segment_bar)
+                    key = lesson.keys[index]
+                    iv = key.iv and decrypt.ParseIV(key.iv)
+                    downloaded = self.__isSegmentComplete(segment.segment, completed, lesson_container)
+                    in_flight.add(self.__executor.submit(self.__decryptSegment, lesson, index, segment, lesson_container, downloaded, key.key, iv))
+                self.__setQueueDepth(0)
+                self.__collectDecrypted(concurrent.futures.as_completed(in_flight), reassembler, segment_bar)
+            except:
+                self.__cancel(in_flight)
+                raise
+        os.replace(temp_path, decrypted_path)
+
+    def __collectDecrypted(self, futures, reassembler, segment_bar):
+        for future in futures:
+            index, data = future.result()
+            reassembler.Add(index, data)
+            segment_bar.next()
+
+    def __decryptSegment(self, lesson, index, segment, lesson_container, downloaded, key, iv):
+        buffer = bytearray(LessonContainer.CHUNK_SIZE)
+        plain = io.BytesIO()
+        decryptor = decrypt.CreateDecryptor(key, iv, plain, buffer)
+        if downloaded:
+            for chunk in lesson_container.ReadSegment(segment.segment):
+                decryptor.Update(chunk)
+            decryptor.Finalize()
+            data = plain.getvalue()
+            decrypt.ValidateTs(data, "Segment {} of video with id {}".format(segment.segment.uri, segment.uuid))
+            return index, data
+
+        # A retry resumes the ciphertext where the previous attempt stopped, the decryptor state carries over.
+        received = 0
+        def attempt():
+            nonlocal plain, decryptor, received
+            start = time.monotonic()
+            try:
+                response = self.__requestSegment(lesson, segment, received)
+            except requests.exceptions.HTTPError as e:
+                if received and e.response is not None and e.response.status_code == 416:
+                    plain = io.BytesIO()
+                    decryptor = decrypt.CreateDecryptor(key, iv, plain, buffer)
+                    received = 0
+                raise
+            finally:
+                segment.response = None
+            if received and response.status_code != 206:
+                plain = io.BytesIO()
+                decryptor = decrypt.CreateDecryptor(key, iv, plain, buffer)
+                received = 0
+            offset = received
+            for chunk in self.client.IterContent(response, LessonContainer.CHUNK_SIZE):
+                decryptor.Update(chunk)
+                received += len(chunk)
+            CheckContentLength(response, received - offset, "Segment {} of video with id {}".format(segment.segment.uri, segment.uuid))
+            elapsed = time.monotonic() - start
+            self.controller.Record(received - offset, elapsed)
+            metrics.registry.Observe('hls_segment_seconds', elapsed)
+        self.__retry(attempt, "Segment {} of video with id {}".format(segment.segment.uri, segment.uuid))
+        decryptor.Finalize()
+        data = plain.getvalue()
+        decrypt.ValidateTs(data, "Segment {} of video with id {}".format(segment.segment.uri, segment.uuid))
+        return index, data
+
+    def __getDigest(self, meta):
+        return hashlib.sha256(json.dumps(meta, sort_keys=True).encode()).hexdigest()
+
     def Download(self, trainers='trainers.txt'):
+        """Download every trainer listed in the file."""
         with open(trainers, 'r') as t:
+            trainer_ids = [x.strip() for x in t if x.strip()]
+        self.DownloadCatalog(trainer_ids)
+
+    def DownloadCatalog(self, trainer_ids, course_ids=None, lesson_ids=None, on_lesson=None):
+        """Download the trainers, only the courses in course_ids and the lessons in lesson_ids when given.
 
-            for trainer_id in t:
-                trainer_id = trainer_id.strip()
+        Lessons are resolved (video API, master and best stream playlists, keys) by a pool of
+        resolvers running up to self.lookahead lessons ahead of the one whose segments are being
+        downloaded, so the setup of the next lessons overlaps with the current transfer.
+
+        on_lesson(lesson_path, error) is called for every lesson once it is on disk, including
+        lessons downloaded by previous runs, and for every lesson that failed. A trainer or course
+        whose catalog request failed is reported with its own path, and the run moves on.
+        """
+        if not os.path.isdir(Downloader.__ROOT):
+            os.mkdir(Downloader.__ROOT)
+        self.manifest = Manifest(os.path.join(Downloader.__ROOT, 'manifest.db'))
+        self.failures = 0
+        self.__on_lesson = on_lesson
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor, \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=self.resolvers) as resolver:
+                self.__executor = executor
+                current = None
+                courses = self.__iterCourses(trainer_ids, course_ids and set(course_ids), lesson_ids and set(lesson_ids))
+                for course, index, lesson_future in self.__resolveAhead(courses, resolver):
+                    if current is not course:
+                        self.__finishCourse(current, course)
+                        current = course
+                    try:
+                        # Time spent waiting for the resolvers is time the segment workers are idle.
+                        with metrics.registry.Time('hls_resolve_wait_seconds'):
+                            lesson = lesson_future.result()
+                        with metrics.registry.Time('hls_lesson_download_seconds'):
+                            self.__downloadLesson(course, index, lesson)
+                        self.__notify(course.container.path, lesson.uuid)
+                    except Exception as e:
+                        self.__notify(course.container.path, course.course.lessons[index].uuid, e)
+                        self.__recordFailure(course, course.course.lessons[index], e)
+                    print('\n')
+                self.__finishCourse(current, None)
+        finally:
+            # Also after a failure, so that the service can run the next job.
+            self.__executor = None
+            self.__on_lesson = None
+            self.manifest.Close()
+        logging.info("{} requests served by {} connections.".format(self.client.requests, self.client.GetConnectionCount()))
+
+    def Plan(self, trainers='trainers.txt'):
+        """Print the estimated size and duration of every course of the trainers, without downloading segments.
+
+        Only the APIs and the playlists are requested, lessons are resolved in parallel by the resolvers.
+        """
+        with open(trainers, 'r') as t, concurrent.futures.ThreadPoolExecutor(max_workers=self.resolvers) as resolver:
+            trainer_ids = [x.strip() for x in t if x.strip()]
+            total = PlanTotal()
+            for trainer_id in trainer_ids:
                 trainer = self.DownloadTrainer(trainer_id)
-                trainer_container = Container(trainer_id, './download/')
-                trainer_container.WriteMetadata(trainer.metadata)
-                print("Processing trainer with id {}.".format(trainer_id))
-                for index, course_request in enumerate(trainer.courses):
+                trainer_total = PlanTotal()
+                print("Trainer {}:".format(trainer_id))
+                for course_request in trainer.courses:
                     course = self.DownloadCourse(course_request)
-                    course_container = Container(course.uuid, trainer_container.path)
-                    course_container.WriteMetadata(course.metadata)
-                    print("Processing course {}/{}: '{}'".format(index+1, len(trainer.courses), course.metadata['data']['highlights']))
-                    for index, lesson_request in enumerate(course.lessons):
-                        lesson = self.DownloadLessons(lesson_request)
-                        lesson_container = LessonContainer(lesson.uuid, course_container.path)
-                        lesson_container.WriteMetadata(lesson.metadata)
-                        lesson_container.WriteKey(lesson.key)
-                        segment_bar = ChargingBar("Downloading lesson {}/{}:".format(index+1, len(course.lessons)), max=len(lesson.segments), suffix='%(index)d/%(max)d - ETA %(eta)ds')
-                        for segment in lesson.segments:
-                            if not lesson_container.IsSegmentDownloaded(segment.segment):
-                                response = segment.DoRequest()
-                                lesson_container.WriteSegment(segment.segment, response)
-                            segment_bar.next()
-                        print('\n')
-                    print("Processing course '{}' completed.".format(course.metadata['data']['highlights']))
-                print("Trainer {} completed.".format(trainer_id))
+                    course_total = PlanTotal()
+                    for size, duration in resolver.map(self.__estimateLesson, course.lessons):
+                        course_total.Add(size, duration)
+                    print("\tCourse '{}': {}.".format(course.metadata['data']['highlights'], course_total))
+                    trainer_total.Merge(course_total)
+                print("Trainer {}: {}.".format(trainer_id, trainer_total))
+                total.Merge(trainer_total)
+            print("Total: {}.".format(total))
+        return total
+
+    def __estimateLesson(self, lesson_request):
+        try:
+            lesson_request.DoRequest()
+            master = lesson_request.GetMasterRequest()
+            master.DoRequest()
+            best_stream = master.GetBestStreamRequest(self.policy)
+            best_stream.DoRequest()
+            return best_stream.EstimateSize(), best_stream.GetDuration()
+        except Exception as e:
+            logging.error("Estimate for lesson with id {} failed: {}".format(lesson_request.uuid, e))
+            return None, None
+
+    def __downloadLesson(self, course, index, lesson):
+        lesson_container = LessonContainer(lesson.uuid, course.container.path, self.store)
+        lesson_container.WriteMetadata(lesson.metadata)
+        lesson_container.WriteKeys(lesson.keys)
+        segment_bar = ChargingBar("Downloading lesson {}/{}:".format(index+1, len(course.course.lessons)), max=len(lesson.segments), suffix='%(index)d/%(max)d - ETA %(eta)ds')
+        if not self.decrypt:
+            self.DownloadSegments(lesson, lesson_container, segment_bar)
+        elif not lesson_container.IsDecrypted():
+            self.DownloadDecryptedSegments(lesson, lesson_container, segment_bar)
+        self.manifest.MarkLessonComplete(lesson.uuid)
+
+    def __recordFailure(self, course, lesson_request, error):
+        """A failed lesson is recorded and skipped, until there are more than max_failures failures in the run."""
+        self.failures += 1
+        course.failed = True
+        metrics.registry.Increment('hls_lesson_failures_total')
+        self.manifest.MarkLessonFailed(lesson_request.uuid)
+        logging.error("Lesson with id {} failed: {}".format(lesson_request.uuid, error))
+        print("\nLesson with id {} failed and will be retried on the next run: {}".format(lesson_request.uuid, error))
+        self.__checkFailures()
+
+    def __recordCatalogFailure(self, description, path, error):
+        """A trainer or course whose catalog request failed after the retries is skipped like a failed lesson, and reported with its own path."""
+        self.failures += 1
+        metrics.registry.Increment('hls_catalog_failures_total')
+        logging.error("{} failed: {}".format(description, error))
+        print("\n{} failed and will be retried on the next run: {}".format(description, error))
+        if self.__on_lesson is not None:
+            self.__on_lesson(path, error)
+        self.__checkFailures()
+
+    def __checkFailures(self):
+        if self.max_failures is not None and self.failures > self.max_failures:
+            raise Exception("Too many failures ({}), giving up.".format(self.failures))
+
+    def __notify(self, course_path, lesson_uuid, error=None):
+        if self.__on_lesson is not None:
+            self.__on_lesson(os.path.join(course_path, lesson_uuid), error)
+
+    def __iterCourses(self, trainer_ids, course_ids=None, lesson_ids=None):
+        """Walk the catalog yielding the courses that have lessons left to download."""
+        for trainer_id in trainer_ids:
+            try:
+                trainer = self.DownloadTrainer(trainer_id)
+            except Exception as e:
+                self.__recordCatalogFailure("Trainer {}".format(trainer_id), os.path.join(Downloader.__ROOT, trainer_id), e)
+                continue
+            trainer_container = Container(trainer_id, Downloader.__ROOT)
+            trainer_container.WriteMetadata(trainer.metadata)
+            for index, course_request in enumerate(trainer.courses):
+                if course_ids is not None and course_request.uuid not in course_ids:
+                    continue
+                try:
+                    course = self.DownloadCourse(course_request)
+                except Exception as e:
+                    self.__recordCatalogFailure("Course {} of trainer {}".format(course_request.uuid, trainer_id), os.path.join(trainer_container.path, course_request.uuid), e)
+                    continue
+                selected = [(i, x) for i, x in enumerate(course.lessons) if lesson_ids is None or x.uuid in lesson_ids]
+                course_path = os.path.join(trainer_container.path, course.uuid)
+                digest = self.__getDigest(course.metadata)
+                if not self.verify and self.manifest.IsCourseComplete(course.uuid, digest):
+                    logging.info("Course {} of trainer {} unchanged and already downloaded.".format(course.uuid, trainer_id))
+                    for _, lesson_request in selected:
+                        self.__notify(course_path, lesson_request.uuid)
+                    continue
+                course_container = Container(course.uuid, trainer_container.path)
+                course_container.WriteMetadata(course.metadata)
+                lessons = []
+                for i, lesson_request in selected:
+                    if self.verify or not self.manifest.IsLessonComplete(lesson_request.uuid):
+                        lessons.append((i, lesson_request))
+                    else:
+                        self.__notify(course_path, lesson_request.uuid)
+                partial = len(selected) < len(course.lessons)
+                pending = PendingCourse(trainer_id, index, len(trainer.courses), course, digest, course_container, lessons, partial)
+                if not lessons:
+                    if not partial:
+                        self.manifest.MarkCourseComplete(course.uuid, digest)
+                    continue
+                yield pending
+
+    def __resolveAhead(self, courses, resolver):
+        """Yield (course, index, future of the resolved lesson) in catalog order, keeping a bounded queue of lessons being resolved."""
+        queue = collections.deque()
+        for course in courses:
+            for index, lesson_request in course.lessons:
+                queue.append((course, index, resolver.submit(self.DownloadLessons, lesson_request)))
+                if len(queue) > self.lookahead:
+                    yield queue.popleft()
+        while queue:
+            yield queue.popleft()
+
+    def __finishCourse(self, previous, following):
+        if previous is not None:
+            if previous.failed:
+                print("Processing course '{}' completed with failed lessons.".format(previous.course.metadata['data']['highlights']))
+            elif previous.partial:
+                print("Processing lessons of course '{}' completed.".format(previous.course.metadata['data']['highlights']))
+            else:
+                self.manifest.MarkCourseComplete(previous.course.uuid, previous.digest)
+                print("Processing course '{}' completed.".format(previous.course.metadata['data']['highlights']))
+            if following is None or following.trainer_id != previous.trainer_id:
+                print("Trainer {} completed.".format(previous.trainer_id))
+        if following is not None:
+            if previous is None or following.trainer_id != previous.trainer_id:
+                print("Processing trainer with id {}.".format(following.trainer_id))
+            print("Processing course {}/{}: '{}'".format(following.index+1, following.total, following.course.metadata['data']['highlights']))
 
 if __name__ == '__main__':
-    downloader = Downloader()
-    downloader.Download()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=8, help='Number of segments downloaded in parallel.')
+    parser.add_argument('--connect-timeout', type=float, default=10, help='Seconds to wait for a connection to be established.')
+    parser.add_argument('--read-timeout', type=float, default=60, help='Seconds to wait for data from the server.')
+    parser.add_argument('--decrypt', action='store_true', help='Decrypt segments while downloading them, without storing them encrypted.')
+    parser.add_argument('--verify', action='store_true', help='Revisit completed lessons and check segment sizes on disk against the manifest.')
+    parser.add_argument('--cache-ttl', type=float, default=24 * 60 * 60, help='Seconds trainer and course responses are reused before being revalidated.')
+    parser.add_argument('--resolvers', type=int, default=4, help='Number of lessons whose playlists and keys are resolved in parallel.')
+    parser.add_argument('--lookahead', type=int, default=8, help='Number of upcoming lessons resolved ahead of the one being downloaded.')
+    parser.add_argument('--max-in-flight', type=int, default=None, help='Maximum number of requests in flight, segment bodies included until fully read, by default workers plus resolvers.')
+    parser.add_argument('--max-rate', type=float, default=None, help='Global bandwidth cap for segments, in KiB/s.')
+    parser.add_argument('--max-host-rate', type=float, default=None, help='Bandwidth cap for segments from each host, in KiB/s.')
+    parser.add_argument('--adaptive', action='store_true', help='Adapt the number of parallel segment downloads, up to --workers, to the observed throughput and latency.')
+    parser.add_argument('--retries', type=int, default=5, help='Retries of a segment or catalog request after a transient failure.')
+    parser.add_argument('--backoff', type=float, default=0.5, help='Base delay in seconds of the exponential backoff between retries.')
+    parser.add_argument('--max-failures', type=int, default=10, help='Failed lessons, courses and trainers skipped before giving up the run.')
+    parser.add_argument('--max-bandwidth', type=float, default=None, help='Choose variants up to this bandwidth, in kbit/s.')
+    parser.add_argument('--max-height', type=int, default=None, help='Choose variants up to this vertical resolution.')
+    parser.add_argument('--codecs', default=None, help='Comma separated codecs to prefer, e.g. avc1,hvc1.')
+    parser.add_argument('--no-store', action='store_true', help='Keep segments only in the lesson folders instead of hardlinking them to the content-addressed store.')
+    parser.add_argument('--plan', action='store_true', help='Only print the estimated size and duration of the courses, without downloading them.')
+    metrics.AddArguments(parser)
+    args = parser.parse_args()
+    policy = VariantPolicy(args.max_bandwidth and args.max_bandwidth * 1000, args.max_height, args.codecs and args.codecs.split(','))
+    max_rate = args.max_rate and args.max_rate * 1024
+    max_host_rate = args.max_host_rate and args.max_host_rate * 1024
+
+    downloader = Downloader(workers=args.workers, connect_timeout=args.connect_timeout, read_timeout=args.read_timeout, decrypt=args.decrypt, verify=args.verify, cache_ttl=args.cache_ttl,
+                            resolvers=args.resolvers, lookahead=args.lookahead, max_in_flight=args.max_in_flight,
+                            max_rate=max_rate, max_host_rate=max_host_rate, adaptive=args.adaptive,
+                            retries=args.retries, backoff=args.backoff, max_failures=args.max_failures, policy=policy, store=not args.no_store)
+    with metrics.Collect(args):
+        if args.plan:
+            downloader.Plan()
+        else:
+            downloader.Download()
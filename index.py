@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+class PackageIndex:
+    """Record of the inputs package.py already processed and of the outputs produced from them.
+
+    Inputs are identified by size and modification time; when those change and the input was
+    recorded with a digest, its content is hashed so that a file rewritten with the same content
+    doesn't count as changed. Together with every input the index keeps the data package.py
+    extracted from it, so unchanged metadata doesn't need to be read at all.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        with self.__lock, self.__connection:
+            # WAL needs shared memory, which network filesystems don't provide: the rollback journal is
+            # used, and files created in WAL mode by earlier versions are switched back to it.
+            self.__connection.execute("PRAGMA journal_mode=DELETE")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS inputs (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, digest TEXT, output TEXT, data TEXT)")
+            self.__entries = {x[0]: x[1:] for x in self.__connection.execute("SELECT * FROM inputs")}
+
+    def IsUnchanged(self, path, output=None):
+        """The input didn't change since it was recorded and, if given, produced output which still exists."""
+        with self.__lock:
+            entry = self.__entries.get(path)
+        if entry is None:
+            return False
+        size, mtime, digest, recorded_output, data = entry
+        if output is not None and (output != recorded_output or not os.path.exists(output)):
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if (stat.st_size, stat.st_mtime_ns) == (size, mtime):
+            return True
+        if digest is None or PackageIndex.__hash(path) != digest:
+            return False
+        # Same content, only rewritten: remember the new signature.
+        self.__put(path, (stat.st_size, stat.st_mtime_ns, digest, recorded_output, data))
+        return True
+
+    def GetOutput(self, path):
+        """Output recorded for the input, None if there is none."""
+        with self.__lock:
+            entry = self.__entries.get(path)
+        return entry[3] if entry else None
+
+    def GetData(self, path):
+        with self.__lock:
+            entry = self.__entries.get(path)
+        return json.loads(entry[4]) if entry and entry[4] is not None else None
+
+    def Record(self, path, output=None, data=None, hash=False):
+        """Remember the current state of an input; with hash its content digest is stored too."""
+        stat = os.stat(path)
+        digest = PackageIndex.__hash(path) if hash else None
+        self.__put(path, (stat.st_size, stat.st_mtime_ns, digest, output, json.dumps(data) if data is not None else None))
+
+    def Clear(self):
+        with self.__lock, self.__connection:
+            self.__connection.execute("DELETE FROM inputs")
+            self.__entries = {}
+
+    def Close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    def __put(self, path, entry):
+        with self.__lock, self.__connection:
+            self.__connection.execute("INSERT OR REPLACE INTO inputs VALUES (?, ?, ?, ?, ?, ?)", (path,) + entry)
+            self.__entries[path] = entry
+
+    @staticmethod
+    def __hash(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
@@ -0,0 +1,83 @@
+import sqlite3
+import threading
+
+class Manifest:
+    """Journal of what has been downloaded, so interrupted runs resume without probing the filesystem.
+
+    Segments are recorded with their length and SHA-256 once they are completely written;
+    lessons and courses once all of their segments are. Courses also keep a digest of their
+    metadata, so that a course that gained lessons is visited again.
+    """
+    __COMPLETE = 'complete'
+    __FAILED = 'failed'
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        with self.__lock, self.__connection:
+            # WAL needs shared memory, which network filesystems don't provide: the rollback journal is
+            # used, and files created in WAL mode by earlier versions are switched back to it.
+            self.__connection.execute("PRAGMA journal_mode=DELETE")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS segments (lesson TEXT, uri TEXT, length INTEGER, checksum TEXT, state TEXT, PRIMARY KEY (lesson, uri))")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS lessons (uuid TEXT PRIMARY KEY, state TEXT)")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS courses (uuid TEXT PRIMARY KEY, state TEXT, digest TEXT)")
+            columns = [x[1] for x in self.__connection.execute("PRAGMA table_info(courses)")]
+            if 'digest' not in columns:
+                self.__connection.execute("ALTER TABLE courses ADD COLUMN digest TEXT")
+
+    def GetCompletedSegments(self, lesson):
+        """Map uri -> (length, checksum) of the segments of a lesson already downloaded."""
+        with self.__lock:
+            rows = self.__connection.execute("SELECT uri, length, checksum FROM segments WHERE lesson = ? AND state = ?", (lesson, Manifest.__COMPLETE))
+            return {uri: (length, checksum) for uri, length, checksum in rows}
+
+    def MarkSegmentComplete(self, lesson, uri, length, checksum):
+        with self.__lock, self.__connection:
+            self.__connection.execute("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?)", (lesson, uri, length, checksum, Manifest.__COMPLETE))
+
+    def IsLessonComplete(self, uuid):
+        return self.__getState('lessons', uuid) == Manifest.__COMPLETE
+
+    def MarkLessonComplete(self, uuid):
+        self.__setState('lessons', uuid, Manifest.__COMPLETE)
+
+    def MarkLessonFailed(self, uuid):
+        self.__setState('lessons', uuid, Manifest.__FAILED)
+
+    def IsCourseComplete(self, uuid, digest):
+        """A course is complete only if its metadata didn't change since it was completed."""
+        with self.__lock:
+            row = self.__connection.execute("SELECT state, digest FROM courses WHERE uuid = ?", (uuid,)).fetchone()
+            return row == (Manifest.__COMPLETE, digest)
+
+    def MarkCourseComplete(self, uuid, digest):
+        with self.__lock, self.__connection:
+            self.__connection.execute("INSERT OR REPLACE INTO courses VALUES (?, ?, ?)", (uuid, Manifest.__COMPLETE, digest))
+
+    def InvalidateSegment(self, lesson, uri):
+        """Forget a segment found corrupted, together with its lesson, so that the downloader fetches it again."""
+        with self.__lock, self.__connection:
+            self.__connection.execute("DELETE FROM segments WHERE lesson = ? AND uri = ?", (lesson, uri))
+            self.__connection.execute("DELETE FROM lessons WHERE uuid = ?", (lesson,))
+
+    def InvalidateLesson(self, uuid):
+        with self.__lock, self.__connection:
+            self.__connection.execute("DELETE FROM lessons WHERE uuid = ?", (uuid,))
+
+    def InvalidateCourse(self, uuid):
+        with self.__lock, self.__connection:
+            self.__connection.execute("DELETE FROM courses WHERE uuid = ?", (uuid,))
+
+    def Close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    def __getState(self, table, uuid):
+        with self.__lock:
+            row = self.__connection.execute("SELECT state FROM {} WHERE uuid = ?".format(table), (uuid,)).fetchone()
+            return row[0] if row else None
+
+    def __setState(self, table, uuid, state):
+        with self.__lock, self.__connection:
+            self.__connection.execute("INSERT OR REPLACE INTO {} VALUES (?, ?)".format(table), (uuid, state))
@@ -0,0 +1,167 @@
+import bisect
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def Observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    """Counters, gauges and histograms of a run, identified by name and labels.
+
+    A snapshot can be appended as a JSON line to a file or written as a Prometheus text file
+    (for the node exporter's textfile collector), depending on the extension of the path.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__gauges = {}
+        self.__histograms = {}
+        self.__exporter = None
+        self.__stop = threading.Event()
+
+    def Increment(self, name, value=1, **labels):
+        key = Metrics.__getKey(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def SetGauge(self, name, value, **labels):
+        with self.__lock:
+            self.__gauges[Metrics.__getKey(name, labels)] = value
+
+    def Observe(self, name, value, **labels):
+        key = Metrics.__getKey(name, labels)
+        with self.__lock:
+            if key not in self.__histograms:
+                self.__histograms[key] = Histogram(Metrics.BUCKETS)
+            self.__histograms[key].Observe(value)
+
+    @contextlib.contextmanager
+    def Time(self, name, **labels):
+        """Observe the seconds spent in the block, also when it raises."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.Observe(name, time.monotonic() - start, **labels)
+
+    def GetSnapshot(self):
+        with self.__lock:
+            return {
+                'time': time.time(),
+                'counters': [{'name': n, 'labels': dict(l), 'value': v} for (n, l), v in self.__counters.items()],
+                'gauges': [{'name': n, 'labels': dict(l), 'value': v} for (n, l), v in self.__gauges.items()],
+                'histograms': [{'name': n, 'labels': dict(l), 'buckets': list(h.buckets), 'counts': list(h.counts), 'sum': h.sum, 'count': h.count}
+                               for (n, l), h in self.__histograms.items()]
+            }
+
+    def Write(self, path):
+        """Append a JSON line with the current values, or replace the file if it ends with .prom."""
+        if not path.endswith('.prom'):
+            with open(path, 'a') as m:
+                m.write(json.dumps(self.GetSnapshot()) + '\n')
+            return
+        temp_path = path + '.part'
+        with open(temp_path, 'w') as m:
+            m.write(self.GetPrometheusText())
+        os.replace(temp_path, path)
+
+    def GetPrometheusText(self):
+        return Metrics.__formatPrometheus(self.GetSnapshot())
+
+    def StartExport(self, path, interval=10):
+        """Write the metrics every interval seconds from a background thread until StopExport."""
+        def export():
+            while not self.__stop.wait(interval):
+                self.Write(path)
+        self.__stop.clear()
+        self.__exporter = threading.Thread(target=export, daemon=True)
+        self.__exporter.start()
+
+    def StopExport(self, path):
+        if self.__exporter is not None:
+            self.__stop.set()
+            self.__exporter.join()
+            self.__exporter = None
+        self.Write(path)
+
+    @staticmethod
+    def __getKey(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    @staticmethod
+    def __formatPrometheus(snapshot):
+        def labels(values, extra=None):
+            items = list(values.items()) + (extra or [])
+            if not items:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+        lines = []
+        typed = set()
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for kind in ['counters', 'gauges']:
+            for metric in sorted(snapshot[kind], key=lambda x: x['name']):
+                declare(metric['name'], 'counter' if kind == 'counters' else 'gauge')
+                lines.append('{}{} {}'.format(metric['name'], labels(metric['labels']), metric['value']))
+        for metric in sorted(snapshot['histograms'], key=lambda x: x['name']):
+            name = metric['name']
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(metric['buckets'] + ['+Inf'], metric['counts']):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, labels(metric['labels'], [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, labels(metric['labels']), metric['sum']))
+            lines.append('{}_count{} {}'.format(name, labels(metric['labels']), metric['count']))
+        return '\n'.join(lines) + '\n'
+
+registry = Metrics()
+
+@contextlib.contextmanager
+def Profile(path):
+    """Collect a cProfile of the calling thread into path, if given; the result can be read with pstats."""
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+def AddArguments(parser):
+    parser.add_argument('--metrics', default=None, help='File the metrics are written to: a Prometheus text file if it ends with .prom, JSON lines otherwise.')
+    parser.add_argument('--metrics-interval', type=float, default=10, help='Seconds between two writes of the metrics.')
+    parser.add_argument('--profile', default=None, help='File to save a cProfile of the main thread to.')
+
+@contextlib.contextmanager
+def Collect(args):
+    """Export the metrics and profile the block as requested by the arguments added by AddArguments."""
+    if args.metrics:
+        registry.StartExport(args.metrics, args.metrics_interval)
+    try:
+        with Profile(args.profile):
+            yield
+    finally:
+        if args.metrics:
+            registry.StopExport(args.metrics)
@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 import json
 import os
+import argparse
+import subprocess
+import tempfile
+import concurrent.futures
 from shutil import copyfile
 import yaml
+import decrypt
+import metrics
+import scan
+from index import PackageIndex
 
 def GetDecryptedFileName(lesson_path):
     """Decrypted file in a lesson folder follow the convention lesson_id.decrypted."""
@@ -37,62 +45,215 @@ def RemoveUnneededInfo(meta):
         trimmed['lessons'].append(trimmed_lesson)
     return trimmed
 
-if __name__ == '__main__':
-    package_dir = './package'
-    trainers = [x for x in os.listdir('./download') if os.path.isdir(os.path.join('./download',x))]
+def IsUpToDate(input_path, output_path):
+    """The output is up to date if it exists and is newer than its input."""
+    try:
+        return os.path.getmtime(output_path) >= os.path.getmtime(input_path)
+    except OSError:
+        return False
+
+def Remux(lesson_path, output_path, stream=False):
+    """Copy the streams of a lesson into an MP4 container with ffmpeg.
+
+    With stream the encrypted segments are decrypted straight into ffmpeg's stdin, so the
+    decrypted file doesn't need to exist. The MP4 is renamed in place only if ffmpeg succeeds.
+    """
+    temp_path = output_path + '.part'
+    command = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error']
+    if stream:
+        command += ['-f', 'mpegts', '-i', 'pipe:0']
+    else:
+        command += ['-i', GetDecryptedFileName(lesson_path)]
+    command += ['-codec', 'copy', '-f', 'mp4', temp_path]
+
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE if stream else subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=errors)
+        if stream:
+            try:
+                decrypt.Decrypt().DecryptSegments(lesson_path, decrypt.ListSegments(lesson_path), process.stdin)
+            except BrokenPipeError:
+                # ffmpeg exited early, the exit code tells why.
+                pass
+            except BaseException as e:
+                # Killed before its stdin is closed, so that ffmpeg doesn't take the failure for the end of the lesson.
+                process.kill()
+                process.wait()
+                if os.path.isfile(temp_path):
+                    os.remove(temp_path)
+                if not isinstance(e, Exception):
+                    raise
+                raise Exception("Decrypting {} for ffmpeg failed: {}".format(lesson_path, e)) from e
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+        returncode = process.wait()
+        if returncode != 0:
+            errors.seek(0)
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+            raise Exception("ffmpeg failed with exit code {} for {}: {}".format(returncode, lesson_path, errors.read().decode(errors='replace').strip()))
+    os.replace(temp_path, output_path)
+
+def GetLessonInput(lesson_path, stream):
+    return lesson_path if stream else GetDecryptedFileName(lesson_path)
+
+def PackageLesson(lesson_path, output_path, stream, index):
+    with metrics.registry.Time('hls_remux_seconds', stream=stream):
+        Remux(lesson_path, output_path, stream)
+    # Decrypted files are hashed, so that one rewritten with the same content isn't remuxed again.
+    index.Record(GetLessonInput(lesson_path, stream), output_path, hash=not stream)
+
+def LoadMetadata(index, path, extract):
+    """Data extract()-ed from a metadata.json, taken from the index if the file didn't change.
+
+    Returns the data and the parsed metadata, which is None when the index was used."""
+    if index.IsUnchanged(path):
+        return index.GetData(path), None
+    meta = ReadMetadata(path)
+    data = extract(meta)
+    index.Record(path, data=data, hash=True)
+    return data, meta
+
+def ReadMetadata(path):
+    with open(path, 'r') as m:
+        return json.loads(m.read())
+
+def PackageCourseMetadata(package_index, course_path, package_dir):
+    """Create the package folder of a course and its metadata.yaml, rewritten only when the course metadata changed.
+
+    Returns the package folder and the lesson ids of the course."""
+    course_meta_path = os.path.join(course_path, 'metadata.json')
+    course, course_meta = LoadMetadata(package_index, course_meta_path, lambda x: {'title': x['data']['title'], 'lessons': [l['id'] for l in x['data']['lessons']]})
+
+    package_course_path = os.path.join(package_dir, course['title'])
+    package_course_meta_path = os.path.join(package_course_path, 'metadata.yaml')
+    if course_meta is None and not os.path.isfile(package_course_meta_path):
+        course_meta = ReadMetadata(course_meta_path)
+
+    if course_meta is not None:
+        if not os.path.isdir(package_course_path):
+            os.mkdir(package_course_path)
+        trimmed = RemoveUnneededInfo(course_meta)
+        with open(package_course_meta_path, 'w') as m:
+            yaml.dump(trimmed, m, allow_unicode=True)
+    return package_course_path, course['lessons']
+
+def IsPackaged(package_index, lesson_path, package_course_path, outputs):
+    """The decrypted file of the lesson is unchanged since it was remuxed into one of outputs, the files in package_course_path.
+
+    Takes a single stat, of the decrypted file, without listing the lesson folder."""
+    decrypted_path = GetDecryptedFileName(lesson_path)
+    output = package_index.GetOutput(decrypted_path)
+    if output is None or os.path.dirname(output) != package_course_path or os.path.basename(output) not in outputs:
+        return False
+    return package_index.IsUnchanged(decrypted_path)
+
+def PlanLesson(package_index, lesson, package_course_path, stream):
+    """None if the scan.Lesson can't be packaged yet, otherwise the arguments of PackageLesson and whether the MP4 is up to date."""
+    if lesson is None:
+        return None
+    lesson_path = lesson.path
+    # An incomplete lesson can still be packaged from a decrypted file, as after an inline decrypt.
+    lesson_stream = stream and lesson.IsComplete() and lesson.HasSegments()
+    if not lesson_stream and not lesson.HasFile(lesson.GetDecryptedName()):
+        return None
+
+    lesson_num, _ = LoadMetadata(package_index, os.path.join(lesson_path, 'metadata.json'), lambda x: x['data']['lesson']['lesson_num'])
+    package_lesson_path = os.path.join(package_course_path, "Lesson_{}.mp4".format(lesson_num))
+    remux = (lesson_path, package_lesson_path, lesson_stream, package_index)
+    input_path = GetLessonInput(lesson_path, lesson_stream)
+    if package_index.IsUnchanged(input_path, package_lesson_path):
+        return remux, True
+    if IsUpToDate(input_path, package_lesson_path):
+        # Packaged before the index existed.
+        package_index.Record(input_path, package_lesson_path, hash=not lesson_stream)
+        return remux, True
+    return remux, False
+
+def Package(root, package_dir, jobs, stream=False, reindex=False, interval=None):
+    tree = scan.Tree(root)
+    trainers = list(tree.trainers)
+    # With a progress interval the run is unattended: only failures and progress lines are printed.
+    report = print if interval is None else lambda *args: None
     if not os.path.isdir(package_dir):
         os.mkdir(package_dir)
 
-    for index, trainer in enumerate(trainers):
-        print("Trainer {}/{}: {}.".format(index+1, len(trainers), trainer))
-        trainer_path = os.path.join('./download', trainer)
-        trainer_meta = None
-        with open(os.path.join(trainer_path, 'metadata.json'), 'r') as m:
-            trainer_meta = json.loads(m.read())
+    package_index = PackageIndex(os.path.join(package_dir, 'index.db'))
+    if reindex:
+        package_index.Clear()
 
-        courses = [x for x in trainer_meta['data']['courses']]
+    remuxes = []
+    up_to_date = 0
+    for index, trainer in enumerate(trainers):
+        report("Trainer {}/{}: {}.".format(index+1, len(trainers), trainer))
+        trainer_path = os.path.join(root, trainer)
+        courses, _ = LoadMetadata(package_index, os.path.join(trainer_path, 'metadata.json'), lambda x: [c['id'] for c in x['data']['courses']])
 
-        for index,course in enumerate(courses):
-            course_id = course['id']
+        for index, course_id in enumerate(courses):
             course_path = os.path.join(trainer_path, course_id)
-            course_meta = None
-            course_meta_path = os.path.join(course_path, 'metadata.json')
 
-            if os.path.isdir(course_path):
-                print("\t✔ Course {}/{}: {}.".format(index+1, len(trainers), course_id))
+            if tree.HasCourse(trainer, course_id):
+                report("\t✔ Course {}/{}: {}.".format(index+1, len(courses), course_id))
             else:
-                print("\t✕ Course {}/{}: {}.".format(index+1, len(trainers), course_id))
+                report("\t✕ Course {}/{}: {}.".format(index+1, len(courses), course_id))
                 continue
 
-            with open(course_meta_path, 'r') as m:
-                course_meta = json.loads(m.read())
-
-            package_course_path = os.path.join(package_dir, course_meta['data']['title'])
-            if not os.path.isdir(package_course_path):
-                os.mkdir(package_course_path)
-            
-            package_course_meta_path = os.path.join(package_course_path, 'metadata.yaml')
-            trimmed = RemoveUnneededInfo(course_meta)
-            with open(package_course_meta_path, 'w') as m:
-                yaml.dump(trimmed, m, allow_unicode=True) 
-
-            lessons = [x for x in course_meta['data']['lessons']]
-            for index, lesson in enumerate(lessons):
-                lesson_id = lesson['id']
-                lesson_path = os.path.join(course_path, lesson_id)
-                lesson_meta = None
-                lesson_meta_path = os.path.join(lesson_path, 'metadata.json')
-
-                if os.path.isdir(lesson_path) and os.path.isfile(GetDecryptedFileName(lesson_path)):
-                    print("\t\t✔ Lesson {}/{}: {}.".format(index+1, len(lessons), lesson_id))
+            package_course_path, lessons = PackageCourseMetadata(package_index, course_path, package_dir)
+            # Listed once per course, so that up to date lessons cost a single stat each.
+            outputs = set(os.listdir(package_course_path)) if os.path.isdir(package_course_path) else set()
+            for index, lesson_id in enumerate(lessons):
+                if not stream and IsPackaged(package_index, os.path.join(course_path, lesson_id), package_course_path, outputs):
+                    report("\t\t✔ Lesson {}/{}: {}.".format(index+1, len(lessons), lesson_id))
+                    up_to_date += 1
+                    continue
+                plan = PlanLesson(package_index, tree.GetLesson(trainer, course_id, lesson_id), package_course_path, stream)
+                if plan is not None:
+                    report("\t\t✔ Lesson {}/{}: {}.".format(index+1, len(lessons), lesson_id))
                 else:                
-                    print("\t\t✕ Lesson {}/{}: {}.".format(index+1, len(lessons), lesson_id))
+                    report("\t\t✕ Lesson {}/{}: {}.".format(index+1, len(lessons), lesson_id))
                     continue
 
-                with open(lesson_meta_path, 'r') as m:
-                    lesson_meta = json.loads(m.read())
+                remux, is_up_to_date = plan
+                if is_up_to_date:
+                    up_to_date += 1
+                else:
+                    remuxes.append(remux)
+            report('\n')
 
-                package_lesson_path = os.path.join(package_course_path, "Lesson_{}.mp4".format(lesson_meta['data']['lesson']['lesson_num']))
-                os.system("ffmpeg -i \"{}\" -hide_banner -loglevel quiet -codec copy {}".format(GetDecryptedFileName(lesson_path), package_lesson_path.replace("'", "\\'").replace(' ', '\ ')))
-            print('\n')
+    RemuxAll(remuxes, jobs, up_to_date, interval)
+    package_index.Close()
+
+def RemuxAll(remuxes, jobs, up_to_date=0, interval=None):
+    """Run the remuxes on a pool of workers; each worker drives its own ffmpeg process."""
+    remuxed = 0
+    failed = 0
+    progress = scan.ProgressLine("Lessons remuxed:", len(remuxes), interval) if interval else None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(PackageLesson, *x): x for x in remuxes}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+                remuxed += 1
+                metrics.registry.Increment('hls_remux_total', result='ok')
+            except Exception as e:
+                failed += 1
+                metrics.registry.Increment('hls_remux_total', result='failed')
+                print("✕ {}".format(e))
+            if progress is not None:
+                progress.next()
+    metrics.registry.Increment('hls_remux_total', up_to_date, result='up_to_date')
+    print("{} lessons remuxed, {} up to date, {} failed.".format(remuxed, up_to_date, failed))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Number of ffmpeg processes run in parallel.')
+    parser.add_argument('--stream', action='store_true', help='Decrypt segments directly into ffmpeg instead of reading the decrypted file.')
+    parser.add_argument('--reindex', action='store_true', help='Forget what was already packaged and check every lesson again.')
+    parser.add_argument('--progress-interval', type=float, default=None, help='Print only a progress line every N seconds and the summary instead of every lesson; 0 prints only the summary.')
+    metrics.AddArguments(parser)
+    args = parser.parse_args()
 
+    with metrics.Collect(args):
+        Package('./download', './package', args.jobs, args.stream, args.reindex, args.progress_interval)
@@ -0,0 +1,143 @@
+import os
+import json
+import time
+
+def ScanFolders(path):
+    """Names of the folders in path, typed by a single os.scandir instead of a stat per entry."""
+    with os.scandir(path) as entries:
+        return [x.name for x in entries if x.is_dir()]
+
+def GetSequenceNumber(segment):
+    """Sequence number in a segment file name like segment12.ts."""
+    return int(segment[segment.find('segment')+len('segment'): segment.rfind('.'):])
+
+class Lesson:
+    """Files of a lesson folder, listed once; their stat is taken on first use and kept."""
+    def __init__(self, path):
+        self.path = path
+        self.id = os.path.basename(path)
+        with os.scandir(path) as entries:
+            self.__files = {x.name: x for x in entries if x.is_file()}
+        self.__segments = None
+
+    def HasFile(self, name):
+        return name in self.__files
+
+    def GetMtime(self, name):
+        return self.__files[name].stat().st_mtime
+
+    def GetDecryptedName(self):
+        return self.id + '.decrypted'
+
+    def GetSegments(self):
+        """Segments in the folder, in playlist order.
+
+        The order is the one of keys.json, written by the downloader from the playlist; lessons
+        downloaded before keys.json existed are sorted by the sequence number in the file name.
+        A lesson with only some of its segments on disk raises, since decrypting it would produce
+        a truncated video; with none of them, as after an inline decrypt, the list is empty.
+        """
+        segments = self.__getPresentSegments()
+        missing = self.GetMissingSegments()
+        if segments and missing:
+            raise Exception("Lesson {} is incomplete: {} of {} segments are missing, starting from {}.".format(
+                self.path, len(missing), len(segments) + len(missing), missing[0]))
+        return segments
+
+    def GetMissingSegments(self):
+        """Segments listed in keys.json which are not in the folder."""
+        return [x for x in self.__getListedSegments() if x not in self.__files]
+
+    def IsComplete(self):
+        return not self.__getPresentSegments() or not self.GetMissingSegments()
+
+    def HasSegments(self):
+        return bool(self.GetSegments())
+
+    def IsDecrypted(self):
+        """The decrypted file exists and is newer than the segments, with a stat of two files.
+
+        The downloader rewrites keys.json whenever it fetches segments of the lesson, so it stands
+        for all of them; lessons downloaded before keys.json existed were fetched in playlist order,
+        so the last segment is the newest. Lessons decrypted while downloading have no segments.
+        """
+        if not self.HasFile(self.GetDecryptedName()):
+            return False
+        segments = self.__getPresentSegments()
+        if not segments:
+            return True
+        reference = 'keys.json' if self.HasFile('keys.json') else segments[-1]
+        return self.GetMtime(reference) <= self.GetMtime(self.GetDecryptedName())
+
+    def __getListedSegments(self):
+        if self.__segments is None:
+            if 'keys.json' in self.__files:
+                with open(os.path.join(self.path, 'keys.json'), 'r') as k:
+                    self.__segments = [x['uri'] for x in json.loads(k.read())['segments']]
+            else:
+                self.__segments = sorted((x for x in self.__files if x.endswith('.ts')), key=GetSequenceNumber)
+        return self.__segments
+
+    def __getPresentSegments(self):
+        return [x for x in self.__getListedSegments() if x in self.__files]
+
+class Tree:
+    """Trainer, course and lesson folders under the download root, walked once.
+
+    Lesson folders are listed only when asked for, and then kept.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.trainers = {}
+        self.__lessons = {}
+        for trainer in ScanFolders(root):
+            trainer_path = os.path.join(root, trainer)
+            self.trainers[trainer] = {x: ScanFolders(os.path.join(trainer_path, x)) for x in ScanFolders(trainer_path)}
+
+    def HasCourse(self, trainer, course):
+        return course in self.trainers.get(trainer, {})
+
+    def GetLesson(self, trainer, course, lesson):
+        """The Lesson, or None if its folder doesn't exist."""
+        key = (trainer, course, lesson)
+        if key not in self.__lessons:
+            if lesson not in self.trainers.get(trainer, {}).get(course, []):
+                return None
+            self.__lessons[key] = Lesson(os.path.join(self.root, trainer, course, lesson))
+        return self.__lessons[key]
+
+    def GetLessons(self):
+        for trainer, courses in self.trainers.items():
+            for course, lessons in courses.items():
+                for lesson in lessons:
+                    yield self.GetLesson(trainer, course, lesson)
+
+class ProgressLine:
+    """Progress for unattended runs: instead of redrawing a bar at every step, a line every interval seconds.
+
+    With interval 0 only the final line is printed.
+    """
+    def __init__(self, message, max, interval):
+        self.message = message
+        self.max = max
+        self.index = 0
+        self.interval = interval
+        self.__start = time.monotonic()
+        self.__last = self.__start
+        self.__printed = None
+
+    def next(self, n=1):
+        self.index += n
+        if self.interval and time.monotonic() - self.__last >= self.interval:
+            self.__print()
+
+    def finish(self):
+        if self.__printed != self.index:
+            self.__print()
+
+    def __print(self):
+        self.__last = time.monotonic()
+        self.__printed = self.index
+        elapsed = self.__last - self.__start
+        eta = elapsed * (self.max - self.index) / self.index if self.index else 0
+        print("{} {}/{} in {:.0f}s - ETA {:.0f}s".format(self.message, self.index, self.max, elapsed, eta), flush=True)
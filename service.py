@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import queue
+import signal
+import logging
+import argparse
+import itertools
+import multiprocessing
+import threading
+import collections
+import concurrent.futures
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import decrypt
+import package
+import metrics
+import scan
+from downloader import Downloader
+from index import PackageIndex
+
+class Job:
+    """A trainer, or one of its courses or lessons, to take through download, decrypt and package."""
+    def __init__(self, id, trainer, course=None, lesson=None):
+        self.id = id
+        self.trainer = trainer
+        self.course = course
+        self.lesson = lesson
+        self.state = 'queued'
+        self.lessons = {}
+        self.errors = []
+        self.pending = 0
+        self.downloaded = False
+        self.created = time.time()
+        self.updated = self.created
+
+    def GetStatus(self):
+        return {
+            'id': self.id,
+            'trainer': self.trainer,
+            'course': self.course,
+            'lesson': self.lesson,
+            'state': self.state,
+            'lessons': dict(collections.Counter(self.lessons.values())),
+            'errors': self.errors[-10:],
+            'created': self.created,
+            'updated': self.updated
+        }
+
+def DecryptLessonJob(lesson_path):
+    """Decrypt a lesson in a worker process, unless its decrypted file is already up to date."""
+    lesson = scan.Lesson(lesson_path)
+    if lesson.IsDecrypted():
+        return lesson_path, 0, 0
+    return decrypt.DecryptLessonJob(lesson_path, segments=lesson.GetSegments())
+
+class Service:
+    """Long-running pipeline taking jobs through download, decrypt and package.
+
+    Every stage has its own workers: a single downloader, which already fetches segments in
+    parallel and enforces the bandwidth limits, a pool of processes decrypting lessons and a pool
+    of threads driving ffmpeg. A lesson moves to the next stage as soon as it leaves the previous
+    one, so the stages of different lessons overlap.
+    """
+    def __init__(self, downloader, root='./download/', package_dir='./package/', decrypt_jobs=2, package_jobs=None, stream=False):
+        self.downloader = downloader
+        self.root = root
+        self.package_dir = package_dir
+        self.stream = stream
+        self.__jobs = collections.OrderedDict()
+        # Jobs waiting on each lesson being decrypted or packaged.
+        self.__lessons = {}
+        self.__ids = itertools.count(1)
+        self.__queue = queue.Queue()
+        self.__lock = threading.Lock()
+        self.__course_lock = threading.Lock()
+        self.__stop = threading.Event()
+
+        if not os.path.isdir(package_dir):
+            os.mkdir(package_dir)
+        self.__index = PackageIndex(os.path.join(package_dir, 'index.db'))
+        # Workers are started on the first lesson, from a callback of the downloader while its threads
+        # are running: a forkserver avoids forking them. Ctrl-C reaches the whole process group,
+        # leave it to Stop to drain the workers.
+        self.__decrypt = concurrent.futures.ProcessPoolExecutor(max_workers=decrypt_jobs, mp_context=multiprocessing.get_context('forkserver'),
+                                                                initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+        self.__package = concurrent.futures.ThreadPoolExecutor(max_workers=package_jobs or os.cpu_count())
+        self.__downloader = threading.Thread(target=self.__download, name='download')
+
+    def Start(self):
+        self.__downloader.start()
+
+    def Stop(self):
+        """Finish the queued jobs and wait for the lessons in every stage."""
+        self.__stop.set()
+        self.__queue.put(None)
+        self.__downloader.join()
+        self.__decrypt.shutdown(wait=True)
+        self.__package.shutdown(wait=True)
+        self.__index.Close()
+
+    def Submit(self, trainer, course=None, lesson=None):
+        with self.__lock:
+            job = Job(str(next(self.__ids)), trainer, course, lesson)
+            self.__jobs[job.id] = job
+        self.__queue.put(job)
+        metrics.registry.SetGauge('hls_service_queued_jobs', self.__queue.qsize())
+        logging.info("Job {} queued for trainer {}, course {}, lesson {}.".format(job.id, trainer, course, lesson))
+        return job
+
+    def GetJob(self, id):
+        with self.__lock:
+            job = self.__jobs.get(id)
+            return job.GetStatus() if job else None
+
+    def GetJobs(self):
+        with self.__lock:
+            return [x.GetStatus() for x in self.__jobs.values()]
+
+    def Watch(self, trainers, interval=5):
+        """Queue a job for every trainer added to the trainers file, checking it every interval seconds."""
+        seen = set()
+        last = None
+        while not self.__stop.is_set():
+            try:
+                modified = os.stat(trainers).st_mtime_ns
+            except FileNotFoundError:
+                modified = None
+            if modified is not None and modified != last:
+                last = modified
+                with open(trainers, 'r') as t:
+                    trainer_ids = [x.strip() for x in t if x.strip()]
+                for trainer_id in trainer_ids:
+                    if trainer_id not in seen:
+                        seen.add(trainer_id)
+                        self.Submit(trainer_id)
+            self.__stop.wait(interval)
+
+    def __download(self):
+        while True:
+            job = self.__queue.get()
+            metrics.registry.SetGauge('hls_service_queued_jobs', self.__queue.qsize())
+            if job is None:
+                return
+            self.__update(job, 'downloading')
+            try:
+                self.downloader.DownloadCatalog([job.trainer], job.course and [job.course], job.lesson and [job.lesson],
+                                                lambda lesson_path, error: self.__onDownloaded(job, lesson_path, error))
+            except Exception as e:
+                logging.error("Job {} failed: {}".format(job.id, e))
+                with self.__lock:
+                    job.errors.append(str(e))
+            with self.__lock:
+                job.downloaded = True
+                self.__checkDone(job)
+
+    def __onDownloaded(self, job, lesson_path, error):
+        with self.__lock:
+            if error is not None:
+                job.lessons[lesson_path] = 'failed'
+                job.errors.append("{}: {}".format(lesson_path, error))
+                return
+            job.pending += 1
+            if job.state == 'downloading':
+                job.state = 'processing'
+            # The same lesson can be queued by two jobs, as a trainer both in the trainers file and
+            # posted to the API: the later job waits for the lesson already in progress.
+            jobs = self.__lessons.setdefault(lesson_path, [])
+            job.lessons[lesson_path] = jobs[0].lessons[lesson_path] if jobs else 'downloaded'
+            jobs.append(job)
+            if len(jobs) > 1:
+                return
+        if self.stream:
+            self.__package.submit(self.__packageLesson, lesson_path)
+            return
+        future = self.__decrypt.submit(DecryptLessonJob, lesson_path)
+        future.add_done_callback(lambda x: self.__onDecrypted(lesson_path, x))
+
+    def __onDecrypted(self, lesson_path, future):
+        try:
+            _, size, seconds = future.result()
+        except Exception as e:
+            self.__finishLesson(lesson_path, e)
+            return
+        if size:
+            decrypt.RecordLesson(size, seconds)
+        with self.__lock:
+            for job in self.__lessons[lesson_path]:
+                job.lessons[lesson_path] = 'decrypted'
+        self.__package.submit(self.__packageLesson, lesson_path)
+
+    def __packageLesson(self, lesson_path):
+        try:
+            # Lessons of the same course share the course folder and its metadata.yaml.
+            with self.__course_lock:
+                package_course_path, _ = package.PackageCourseMetadata(self.__index, os.path.dirname(lesson_path), self.package_dir)
+                plan = package.PlanLesson(self.__index, scan.Lesson(lesson_path), package_course_path, self.stream)
+            if plan is None:
+                raise Exception("Lesson {} has nothing to package.".format(lesson_path))
+            remux, up_to_date = plan
+            if not up_to_date:
+                package.PackageLesson(*remux)
+                metrics.registry.Increment('hls_remux_total', result='ok')
+        except Exception as e:
+            metrics.registry.Increment('hls_remux_total', result='failed')
+            self.__finishLesson(lesson_path, e)
+            return
+        self.__finishLesson(lesson_path)
+
+    def __finishLesson(self, lesson_path, error=None):
+        with self.__lock:
+            jobs = self.__lessons.pop(lesson_path)
+            if error is not None:
+                logging.error("Lesson {} of job {} failed: {}".format(lesson_path, ', '.join(x.id for x in jobs), error))
+            for job in jobs:
+                if error is not None:
+                    job.errors.append("{}: {}".format(lesson_path, error))
+                job.lessons[lesson_path] = 'failed' if error is not None else 'packaged'
+                job.pending -= 1
+                self.__checkDone(job)
+
+    def __checkDone(self, job):
+        job.updated = time.time()
+        if job.downloaded and job.pending == 0:
+            job.state = 'failed' if job.errors else 'done'
+            logging.info("Job {} {}.".format(job.id, job.state))
+
+    def __update(self, job, state):
+        with self.__lock:
+            job.state = state
+            job.updated = time.time()
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """Local API of the service.
+
+    GET /jobs and GET /jobs/<id> report the status of the jobs, POST /jobs with a JSON body
+    {"trainer": ..., "course": ..., "lesson": ...} queues a new one (course and lesson are optional),
+    GET /metrics returns the metrics in the Prometheus text format.
+    """
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/jobs':
+            return self.__sendJson(200, service.GetJobs())
+        if self.path.startswith('/jobs/'):
+            job = service.GetJob(self.path[len('/jobs/'):])
+            return self.__sendJson(200, job) if job else self.__sendJson(404, {'error': 'Job not found.'})
+        if self.path == '/metrics':
+            return self.__send(200, metrics.registry.GetPrometheusText().encode(), 'text/plain; version=0.0.4')
+        self.__sendJson(404, {'error': 'Not found.'})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            return self.__sendJson(404, {'error': 'Not found.'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('content-length', 0))))
+            trainer = body['trainer']
+        except (ValueError, KeyError, TypeError):
+            return self.__sendJson(400, {'error': 'Expected a JSON object with a trainer.'})
+        job = self.server.service.Submit(trainer, body.get('course'), body.get('lesson'))
+        self.__sendJson(201, job.GetStatus())
+
+    def __sendJson(self, status, body):
+        self.__send(status, json.dumps(body).encode(), 'application/json')
+
+    def __send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('content-type', content_type)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service, port):
+        # Only reachable from this machine, the API has no authentication.
+        super().__init__(('127.0.0.1', port), ApiHandler)
+        self.service = service
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8770, help='Port of the local API.')
+    parser.add_argument('--trainers', default='trainers.txt', help='File watched for new trainers to download.')
+    parser.add_argument('--poll', type=float, default=5, help='Seconds between two checks of the trainers file.')
+    parser.add_argument('--workers', type=int, default=8, help='Number of segments downloaded in parallel.')
+    parser.add_argument('--resolvers', type=int, default=4, help='Number of lessons whose playlists and keys are resolved in parallel.')
+    parser.add_argument('--decrypt-jobs', type=int, default=2, help='Number of lessons decrypted in parallel by separate processes.')
+    parser.add_argument('--package-jobs', type=int, default=os.cpu_count(), help='Number of ffmpeg processes run in parallel.')
+    parser.add_argument('--stream', action='store_true', help='Decrypt segments directly into ffmpeg instead of writing the decrypted file.')
+    metrics.AddArguments(parser)
+    args = parser.parse_args()
+
+    with metrics.Collect(args):
+        service = Service(Downloader(workers=args.workers, resolvers=args.resolvers), decrypt_jobs=args.decrypt_jobs, package_jobs=args.package_jobs, stream=args.stream)
+        service.Start()
+        threading.Thread(target=service.Watch, args=(args.trainers, args.poll), daemon=True).start()
+        server = ApiServer(service, args.port)
+        print("Listening on http://127.0.0.1:{}/jobs.".format(args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Finishing the jobs in progress.")
+        finally:
+            server.server_close()
+            service.Stop()
@@ -0,0 +1,46 @@
+import os
+import metrics
+
+class SegmentStore:
+    """Content-addressed store of segments, keeping every distinct content once.
+
+    Objects are named by their SHA-256 and hardlinked into the lesson folders, so decrypt.py and
+    package.py keep reading segment files as before. Where hardlinks aren't supported the segment
+    is kept as a plain file in the lesson folder.
+    """
+    def __init__(self, path='./store/'):
+        self.path = path
+
+        if not os.path.isdir(path):
+            os.mkdir(path)
+
+    def GetPath(self, checksum):
+        return os.path.join(self.path, checksum[:2], checksum)
+
+    def Add(self, temp_path, path, checksum):
+        """Move the complete segment in temp_path to path, sharing the content with identical segments."""
+        object_path = self.GetPath(checksum)
+        link_path = path + '.link'
+        try:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            try:
+                os.link(temp_path, object_path)
+                metrics.registry.Increment('hls_store_total', result='new')
+            except FileExistsError:
+                metrics.registry.Increment('hls_store_total', result='duplicate')
+                metrics.registry.Increment('hls_store_deduplicated_bytes_total', os.path.getsize(temp_path))
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+            os.link(object_path, link_path)
+            os.replace(link_path, path)
+            os.remove(temp_path)
+        except OSError:
+            # Filesystem without hardlinks, or the store on another device.
+            os.replace(temp_path, path)
+
+    def ListObjects(self):
+        for prefix in os.listdir(self.path):
+            prefix_path = os.path.join(self.path, prefix)
+            if os.path.isdir(prefix_path):
+                for name in os.listdir(prefix_path):
+                    yield name, os.path.join(prefix_path, name)
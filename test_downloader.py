@@ -0,0 +1,406 @@
+import io
+import os
+import random
+import shutil
+import sqlite3
+import time
+import types
+import threading
+import m3u8
+import pytest
+from Crypto.Cipher import AES
+import benchmark
+import decrypt
+import downloader
+import index
+import manifest
+import package
+import scan
+import service
+import throttle
+
+@pytest.fixture
+def work_path(tmp_path, monkeypatch):
+    """The downloader works in the current folder and needs a cookie jar."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'cookies.txt').write_text('test=1')
+    return tmp_path
+
+@pytest.fixture
+def serve():
+    """Start mock servers in background threads, stopped at the end of the test."""
+    servers = []
+    def start(catalog=None, **kwargs):
+        server = benchmark.MockServer(catalog or benchmark.MockCatalog(1, 2, 2, 8, 188 * 20), **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def GetUri(server):
+    return 'http://{}:{}/'.format(*server.server_address)
+
+def Download(server, **kwargs):
+    instance = downloader.Downloader(uri=GetUri(server), **kwargs)
+    instance.DownloadCatalog(server.catalog.GetTrainers())
+    return instance
+
+def GetLessons(catalog):
+    for trainer in catalog.GetTrainers():
+        for course in catalog.GetCourses(trainer):
+            for lesson in catalog.GetLessons(course):
+                yield trainer, course, lesson
+
+def CountSegmentRequests(server):
+    return sum(count for path, count in server.requests.items() if path.endswith('.ts'))
+
+def AssertSegments(work_path, catalog):
+    for trainer, course, lesson in GetLessons(catalog):
+        for index in range(catalog.segments):
+            path = work_path / 'download' / trainer / course / lesson / 'segment{}.ts'.format(index)
+            assert path.read_bytes() == catalog.GetSegment(lesson, index)
+
+def AssertDecrypted(work_path, catalog):
+    for trainer, course, lesson in GetLessons(catalog):
+        plain = b''.join(catalog.GetPlain(x) for x in range(catalog.segments))
+        assert (work_path / 'download' / trainer / course / lesson / (lesson + '.decrypted')).read_bytes() == plain
+
+def test_segments_downloaded_in_parallel(work_path, serve):
+    server = serve(latency=0.02)
+    Download(server, workers=4, resolvers=1)
+    AssertSegments(work_path, server.catalog)
+    assert 1 < server.max_in_flight <= 4 + 1
+
+def test_downloaded_segments_skipped(work_path, serve):
+    server = serve()
+    Download(server)
+    requests = CountSegmentRequests(server)
+    assert requests == 4 * server.catalog.segments
+    Download(server)
+    assert CountSegmentRequests(server) == requests
+
+def test_connections_reused(work_path, serve):
+    server = serve()
+    instance = Download(server, workers=4, resolvers=2)
+    assert instance.client.GetConnectionCount() <= 4 + 2
+    assert server.connections <= 4 + 2 < instance.client.requests
+    assert sum(server.requests.values()) == instance.client.requests
+
+def test_catalog_requests_retried(work_path, serve):
+    server = serve()
+    server.failures['/api/courses?trainer_id=t0'] = 1
+    server.failures['/api/course?course_id=t0c1'] = 2
+    server.failures['/api/video?lesson_id=t0c0l1'] = 1
+    server.failures['/t0c1l0/key.bin'] = 1
+    instance = Download(server, backoff=0.01)
+    assert instance.failures == 0
+    assert not +server.failures
+    AssertSegments(work_path, server.catalog)
+
+def test_failing_course_skipped(work_path, serve):
+    server = serve()
+    server.failures['/api/course?course_id=t0c0'] = 1000
+    errors = {}
+    instance = downloader.Downloader(uri=GetUri(server), retries=2, backoff=0.01)
+    instance.DownloadCatalog(['t0'], on_lesson=lambda path, error: errors.__setitem__(path, error))
+    assert instance.failures == 1
+    assert server.requests['/api/course'] == 3 + 1
+    course_path = os.path.join('./download/', 't0', 't0c0')
+    assert isinstance(errors.pop(course_path), Exception)
+    assert set(errors.values()) == {None}
+    assert len(errors) == len(server.catalog.GetLessons('t0c1'))
+    for lesson in server.catalog.GetLessons('t0c1'):
+        for index in range(server.catalog.segments):
+            path = work_path / 'download' / 't0' / 't0c1' / lesson / 'segment{}.ts'.format(index)
+            assert path.read_bytes() == server.catalog.GetSegment(lesson, index)
+
+@pytest.mark.parametrize('decrypt', [False, True])
+def test_truncated_segments_resumed(work_path, serve, decrypt):
+    server = serve(benchmark.MockCatalog(1, 1, 1, 4, 188 * 1000), truncate=True)
+    instance = Download(server, backoff=0.01, decrypt=decrypt)
+    assert instance.failures == 0
+    assert server.ranges == server.catalog.segments
+    if decrypt:
+        AssertDecrypted(work_path, server.catalog)
+    else:
+        AssertSegments(work_path, server.catalog)
+
+@pytest.mark.parametrize('decrypt', [False, True])
+def test_expired_tokens_renewed(work_path, serve, decrypt):
+    server = serve(benchmark.MockCatalog(1, 1, 3, 40, 188 * 20), latency=0.01, token_ttl=0.4)
+    instance = Download(server, workers=2, resolvers=2, backoff=0.01, decrypt=decrypt)
+    assert instance.failures == 0
+    assert server.requests['/api/video'] > 3
+    if decrypt:
+        AssertDecrypted(work_path, server.catalog)
+    else:
+        AssertSegments(work_path, server.catalog)
+
+def test_concurrency_backs_off_on_saturated_link(work_path, serve):
+    server = serve(benchmark.MockCatalog(1, 1, 1, 40, 188 * 100), rate=200 * 1024)
+    instance = downloader.Downloader(uri=GetUri(server), workers=16, resolvers=1)
+    instance.controller = throttle.ConcurrencyController(16, adaptive=True, interval=0.15)
+    limits = []
+    done = threading.Event()
+    def sample():
+        while not done.wait(0.01):
+            limits.append(instance.controller.limit)
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    try:
+        instance.DownloadCatalog(server.catalog.GetTrainers())
+    finally:
+        done.set()
+        sampler.join()
+    AssertSegments(work_path, server.catalog)
+    assert 1 < max(limits) < 16
+    assert any(b < a for a, b in zip(limits, limits[1:]))
+
+def test_max_in_flight_covers_segment_bodies(work_path, serve):
+    server = serve(benchmark.MockCatalog(1, 1, 2, 20, 188 * 100), rate=2 * 1024 * 1024)
+    Download(server, workers=8, resolvers=2, max_in_flight=2)
+    AssertSegments(work_path, server.catalog)
+    assert server.max_in_flight <= 2
+
+def CorruptSegment(work_path, lesson, index):
+    """Flip the ciphertext block holding the sync byte of the second TS packet."""
+    trainer, course = lesson.split('c')[0], lesson.rsplit('l', 1)[0]
+    path = work_path / 'download' / trainer / course / lesson / 'segment{}.ts'.format(index)
+    data = bytearray(path.read_bytes())
+    start = 188 // 16 * 16
+    data[start:start + 16] = bytes(x ^ 0xff for x in data[start:start + 16])
+    path.write_bytes(bytes(data))
+    return path.parent
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_failing_lesson_does_not_stop_decrypt(work_path, serve, capsys, jobs):
+    server = serve()
+    Download(server)
+    lesson_path = CorruptSegment(work_path, 't0c0l1', 3)
+    if jobs > 1:
+        decrypt.DecryptParallel('./download', jobs, interval=0)
+    else:
+        decrypt.DecryptSerial('./download', interval=0)
+    output = capsys.readouterr().out
+    assert "✕ Lesson {} failed:".format(os.path.join('./download', 't0', 't0c0', 't0c0l1')) in output
+    assert "3 lessons decrypted, 1 failed." in output
+    assert not any(x.name.endswith(('.decrypted', '.part')) for x in lesson_path.iterdir())
+    for trainer, course, lesson in GetLessons(server.catalog):
+        if lesson != 't0c0l1':
+            assert (work_path / 'download' / trainer / course / lesson / (lesson + '.decrypted')).is_file()
+
+def test_lesson_shared_by_jobs_processed_once(work_path, serve, monkeypatch):
+    server = serve()
+    packaged = []
+    def PackageLesson(lesson_path, output_path, stream, index):
+        packaged.append(lesson_path)
+        time.sleep(0.2)
+        with open(output_path, 'wb') as o:
+            o.write(b'mp4')
+        index.Record(package.GetLessonInput(lesson_path, stream), output_path, hash=not stream)
+    monkeypatch.setattr(package, 'PackageLesson', PackageLesson)
+    instance = service.Service(downloader.Downloader(uri=GetUri(server)), package_jobs=4)
+    instance.Start()
+    try:
+        jobs = [instance.Submit('t0'), instance.Submit('t0')]
+        while any(instance.GetJob(x.id)['state'] not in ('done', 'failed') for x in jobs):
+            time.sleep(0.05)
+    finally:
+        instance.Stop()
+    assert [instance.GetJob(x.id)['state'] for x in jobs] == ['done', 'done']
+    assert [instance.GetJob(x.id)['lessons'] for x in jobs] == [{'packaged': 4}, {'packaged': 4}]
+    assert sorted(packaged) == sorted(set(packaged))
+
+def test_decrypted_lessons_skipped_until_downloaded_again(work_path, serve, capsys):
+    server = serve()
+    Download(server)
+    decrypt.DecryptSerial('./download', interval=0)
+    assert "4 lessons decrypted, 0 failed." in capsys.readouterr().out
+    decrypt.DecryptSerial('./download', interval=0)
+    assert "0 lessons decrypted, 0 failed." in capsys.readouterr().out
+    keys_path = work_path / 'download' / 't0' / 't0c1' / 't0c1l0' / 'keys.json'
+    later = keys_path.stat().st_mtime + 10
+    os.utime(keys_path, (later, later))
+    decrypt.DecryptSerial('./download', interval=0)
+    assert "1 lessons decrypted, 0 failed." in capsys.readouterr().out
+
+def test_packaged_lessons_not_listed_again(work_path, serve, monkeypatch, capsys):
+    server = serve()
+    Download(server)
+    decrypt.DecryptSerial('./download', interval=0)
+    monkeypatch.setattr(package, 'Remux', lambda lesson_path, output_path, stream=False: shutil.copyfile(package.GetDecryptedFileName(lesson_path), output_path))
+    package.Package('./download', './package', 2, interval=0)
+    assert "4 lessons remuxed, 0 up to date, 0 failed." in capsys.readouterr().out
+
+    listed = []
+    class Lesson(scan.Lesson):
+        def __init__(self, path):
+            listed.append(path)
+            super().__init__(path)
+    monkeypatch.setattr(scan, 'Lesson', Lesson)
+    package.Package('./download', './package', 2, interval=0)
+    assert "0 lessons remuxed, 4 up to date, 0 failed." in capsys.readouterr().out
+    assert listed == []
+
+    lesson_path = os.path.join('./download', 't0', 't0c1', 't0c1l0')
+    with open(package.GetDecryptedFileName(lesson_path), 'ab') as d:
+        d.write(b'\0' * 188)
+    package.Package('./download', './package', 2, interval=0)
+    assert "1 lessons remuxed, 3 up to date, 0 failed." in capsys.readouterr().out
+    assert listed == [lesson_path]
+
+@pytest.mark.parametrize('open_database', [manifest.Manifest, index.PackageIndex])
+def test_databases_use_rollback_journal(tmp_path, open_database):
+    path = str(tmp_path / 'test.db')
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.close()
+    database = open_database(path)
+    database.Close()
+    connection = sqlite3.connect(path)
+    assert connection.execute("PRAGMA journal_mode").fetchone() == ('delete',)
+    connection.close()
+    assert not os.path.exists(path + '-wal')
+
+def WriteSource(path, packets):
+    """MPEG-TS packets numbered in their payload, so that segments decrypted out of order don't match."""
+    path.write_bytes(b''.join(b'\x47' + x.to_bytes(4, 'big') + b'\xff' * 183 for x in range(packets)))
+    return str(path)
+
+def ReadDecrypted(work_path):
+    return {x: x.read_bytes() for x in sorted((work_path / 'download').rglob('*.decrypted'))}
+
+def test_parallel_decrypt_matches_serial(work_path, serve):
+    server = serve(benchmark.MockCatalog(1, 2, 2, 8, 188 * 20, WriteSource(work_path / 'source.ts', 8 * 20)))
+    Download(server)
+    decrypt.DecryptSerial('./download', interval=0)
+    AssertDecrypted(work_path, server.catalog)
+    serial = ReadDecrypted(work_path)
+    for path in serial:
+        path.unlink()
+    decrypt.DecryptParallel('./download', 2, interval=0)
+    assert ReadDecrypted(work_path) == serial
+
+def Encrypt(plain, key, iv, padding=None):
+    padding = padding or bytes([16 - len(plain) % 16]) * (16 - len(plain) % 16)
+    return AES.new(key, AES.MODE_CBC, iv).encrypt(plain + padding)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_decryptor_accepts_unaligned_chunks(seed):
+    generator = random.Random(seed)
+    key, iv = generator.randbytes(16), generator.randbytes(16)
+    plain = generator.randbytes(generator.randrange(1, 2000))
+    data = Encrypt(plain, key, iv)
+    output = io.BytesIO()
+    decryptor = decrypt.SegmentDecryptor(key, iv, output, bytearray(64))
+    start = 0
+    while start < len(data):
+        size = generator.choice([1, 15, 16, 17, 63, 64, 65, 300])
+        decryptor.Update(data[start:start + size])
+        start += size
+    decryptor.Finalize()
+    assert output.getvalue() == plain
+
+@pytest.mark.parametrize('padding', [b'\x00' * 16, b'\x11' * 16, b'\x01\x02\x03\x03'])
+def test_decryptor_rejects_bad_padding(padding):
+    key, iv = bytes(16), bytes(range(16))
+    data = Encrypt(b'\x47' * (32 - len(padding) % 16), key, iv, padding)
+    decryptor = decrypt.SegmentDecryptor(key, iv, io.BytesIO(), bytearray(64))
+    decryptor.Update(data)
+    with pytest.raises(Exception, match='Invalid PKCS7 padding'):
+        decryptor.Finalize()
+
+def test_decryptor_rejects_truncated_block():
+    key, iv = bytes(16), bytes(16)
+    decryptor = decrypt.SegmentDecryptor(key, iv, io.BytesIO(), bytearray(64))
+    decryptor.Update(Encrypt(b'\x47' * 40, key, iv)[:-1])
+    with pytest.raises(Exception, match='not a multiple of the AES block size'):
+        decryptor.Finalize()
+
+@pytest.mark.parametrize('inline', [False, True])
+def test_rotated_keys_decrypted(work_path, serve, inline):
+    catalog = benchmark.MockCatalog(1, 1, 2, 12, 188 * 20, WriteSource(work_path / 'source.ts', 12 * 20), key_rotation=3)
+    server = serve(catalog)
+    instance = Download(server, decrypt=inline)
+    assert instance.failures == 0
+    if not inline:
+        AssertSegments(work_path, catalog)
+        decrypt.DecryptSerial('./download', interval=0)
+    AssertDecrypted(work_path, catalog)
+    # One key per encrypted group: 0 and 3 use the sequence number as IV, 1 an explicit IV, 2 is in clear.
+    assert {x for x in server.requests if x.endswith('.bin')} == {'/t0c0l{}/{}'.format(l, k) for l in range(2) for k in ('key.bin', 'key1.bin', 'key3.bin')}
+
+MASTER = """#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,CODECS="avc1.4d401e,mp4a.40.2"
+low.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2500000,RESOLUTION=1280x720,CODECS="avc1.4d401f,mp4a.40.2"
+mid.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2000000,RESOLUTION=1280x720,CODECS="hvc1.1.6.L93.B0,mp4a.40.2"
+hevc.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=6000000,RESOLUTION=1920x1080,CODECS="avc1.640028,mp4a.40.2"
+high.m3u8
+"""
+
+@pytest.mark.parametrize('policy, expected', [
+    (downloader.VariantPolicy(), 'high.m3u8'),
+    (downloader.VariantPolicy(max_bandwidth=3000000), 'mid.m3u8'),
+    (downloader.VariantPolicy(max_height=720), 'mid.m3u8'),
+    (downloader.VariantPolicy(max_height=720, codecs=['hvc1']), 'hevc.m3u8'),
+    (downloader.VariantPolicy(codecs=['av01', 'hvc1']), 'hevc.m3u8'),
+    (downloader.VariantPolicy(codecs=['av01']), 'high.m3u8'),
+    (downloader.VariantPolicy(max_bandwidth=500000), 'low.m3u8'),
+    (downloader.VariantPolicy(max_height=240, codecs=['hvc1']), 'low.m3u8'),
+])
+def test_variant_policy(policy, expected):
+    assert policy.Choose(m3u8.loads(MASTER).playlists).uri == expected
+
+def GetMasterRequest(text, master_name='http://host/lesson/master.m3u8'):
+    request = downloader.MasterRequest('http://host/', 'lesson', 'token=1', master_name, None)
+    request.response = types.SimpleNamespace(text=text)
+    return request
+
+def test_best_stream_request_of_variant():
+    best_stream = GetMasterRequest(MASTER).GetBestStreamRequest(downloader.VariantPolicy(max_height=720))
+    assert (best_stream.best_stream_name, best_stream.bandwidth, best_stream.response) == ('mid.m3u8', 2500000, None)
+
+MEDIA = """#EXTM3U
+#EXT-X-TARGETDURATION:10
+#EXTINF:10.0,
+segment0.ts
+#EXTINF:6.0,
+segment1.ts
+#EXT-X-ENDLIST
+"""
+
+def test_media_playlist_used_as_best_stream():
+    master = GetMasterRequest(MEDIA, 'http://host/lesson/index.m3u8')
+    best_stream = master.GetBestStreamRequest()
+    assert best_stream.best_stream_name == 'index.m3u8'
+    assert best_stream.response is master.response
+    assert best_stream.bandwidth is None
+    assert best_stream.EstimateSize() is None
+    assert [x.segment.uri for x in best_stream.GetSegmentRequests()] == ['segment0.ts', 'segment1.ts']
+
+def test_master_without_variants_or_segments_rejected():
+    with pytest.raises(Exception, match='neither variants nor segments'):
+        GetMasterRequest("#EXTM3U\n#EXT-X-ENDLIST\n").GetBestStreamRequest()
+
+def GetBestStreamRequest(text, bandwidth=None):
+    request = downloader.BestStreamRequest('http://host/', 'lesson', 'token=1', 'stream.m3u8', None, bandwidth)
+    request.response = types.SimpleNamespace(text=text)
+    return request
+
+def test_size_estimated_from_bandwidth_and_duration():
+    best_stream = GetBestStreamRequest(MEDIA, 800000)
+    assert best_stream.GetDuration() == 16
+    assert best_stream.EstimateSize() == 800000 * 16 // 8
+
+def test_size_taken_from_byte_ranges():
+    ranges = MEDIA.replace('segment0.ts', '#EXT-X-BYTERANGE:1000@0\nsegment.ts').replace('segment1.ts', '#EXT-X-BYTERANGE:500@1000\nsegment.ts')
+    assert GetBestStreamRequest(ranges, 800000).EstimateSize() == 1500
+    # Without a range for every segment the bandwidth estimate is used.
+    partial = MEDIA.replace('segment0.ts', '#EXT-X-BYTERANGE:1000@0\nsegment0.ts')
+    assert GetBestStreamRequest(partial, 800000).EstimateSize() == 800000 * 16 // 8
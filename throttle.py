@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+import metrics
+
+class TokenBucket:
+    """Limits the average throughput to rate bytes per second, allowing bursts up to capacity bytes."""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.__tokens = self.capacity
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def Consume(self, amount):
+        """Take amount tokens, sleeping until the bucket is no longer in debt."""
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+            self.__tokens -= amount
+            wait = -self.__tokens / self.rate if self.__tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class BandwidthLimiter:
+    """Global and per-host token buckets; a rate of None means unlimited."""
+    def __init__(self, rate=None, host_rate=None):
+        self.rate = rate
+        self.host_rate = host_rate
+        self.__global = TokenBucket(rate) if rate else None
+        self.__hosts = {}
+        self.__lock = threading.Lock()
+
+    def Consume(self, host, amount):
+        if self.__global is not None:
+            self.__global.Consume(amount)
+        if self.host_rate:
+            with self.__lock:
+                if host not in self.__hosts:
+                    self.__hosts[host] = TokenBucket(self.host_rate)
+                bucket = self.__hosts[host]
+            bucket.Consume(amount)
+
+class ConcurrencyController:
+    """AIMD controller for the number of segments downloaded in parallel.
+
+    Every interval the throughput and the average segment latency of the window are compared
+    with the previous ones: the limit grows by one while throughput keeps up, and halves when
+    requests fail or latency grows beyond latency_factor times the best observed, a sign that
+    the extra parallelism is only queueing on a saturated link.
+    """
+    def __init__(self, maximum, minimum=1, adaptive=True, interval=2.0, latency_factor=2.0):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.adaptive = adaptive
+        self.interval = interval
+        self.latency_factor = latency_factor
+        self.limit = minimum if adaptive else maximum
+        self.rate = 0.0
+        self.__lock = threading.Lock()
+        self.__start = time.monotonic()
+        self.__bytes = 0
+        self.__latency = 0.0
+        self.__count = 0
+        self.__errors = 0
+        self.__best_latency = None
+        self.__last_rate = 0.0
+
+    def Record(self, length, seconds):
+        """Account a segment received in seconds; failures are reported with RecordError instead."""
+        with self.__lock:
+            self.__bytes += length
+            self.__latency += seconds
+            self.__count += 1
+            elapsed = time.monotonic() - self.__start
+            if elapsed >= self.interval:
+                self.__adjust(elapsed)
+
+    def RecordError(self):
+        with self.__lock:
+            self.__errors += 1
+
+    def __adjust(self, elapsed):
+        self.rate = self.__bytes / elapsed
+        latency = self.__latency / self.__count
+        if self.__best_latency is None or latency < self.__best_latency:
+            self.__best_latency = latency
+
+        if self.adaptive:
+            if self.__errors or latency > self.__best_latency * self.latency_factor:
+                self.limit = max(self.minimum, self.limit // 2)
+            elif self.rate >= self.__last_rate * 0.95:
+                self.limit = min(self.maximum, self.limit + 1)
+        metrics.registry.SetGauge('hls_segment_bytes_per_second', self.rate)
+        metrics.registry.SetGauge('hls_segment_concurrency', self.limit)
+        logging.info("Segment throughput {:.0f} KiB/s, latency {:.2f}s, concurrency {}.".format(self.rate / 1024, latency, self.limit))
+
+        self.__last_rate = self.rate
+        self.__start = time.monotonic()
+        self.__bytes = 0
+        self.__latency = 0.0
+        self.__count = 0
+        self.__errors = 0
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import hashlib
+import argparse
+import threading
+import concurrent.futures
+import decrypt
+from manifest import Manifest
+from store import SegmentStore
+
+class Problem:
+    def __init__(self, kind, path, message, lesson_path=None, uri=None):
+        self.kind = kind
+        self.path = path
+        self.message = message
+        self.lesson_path = lesson_path
+        self.uri = uri
+
+class Verifier:
+    """Check a download tree in parallel.
+
+    Segments recorded as complete in the manifest must exist with the recorded length and SHA-256,
+    decrypted files must be valid MPEG-TS and store objects must match the hash they are named by.
+    Segments hardlinked to the same store object are hashed only once.
+    """
+    __CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, root='./download/', store_path='./store/', jobs=None):
+        self.root = root
+        self.store_path = store_path
+        self.jobs = jobs or os.cpu_count()
+        self.checked = {'segment': 0, 'decrypted': 0, 'object': 0}
+        self.__digests = {}
+        self.__lock = threading.Lock()
+
+    def Verify(self):
+        """Return the problems found."""
+        manifest_path = os.path.join(self.root, 'manifest.db')
+        manifest = Manifest(manifest_path) if os.path.isfile(manifest_path) else None
+        problems = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = []
+            for lesson_path in decrypt.ListLessons(self.root):
+                if manifest is not None:
+                    segments = manifest.GetCompletedSegments(os.path.basename(lesson_path))
+                    futures.extend(executor.submit(self.CheckSegment, lesson_path, uri, length, checksum) for uri, (length, checksum) in segments.items())
+                decrypted_path = os.path.join(lesson_path, os.path.basename(lesson_path) + '.decrypted')
+                if os.path.isfile(decrypted_path):
+                    futures.append(executor.submit(self.CheckDecrypted, lesson_path, decrypted_path))
+            if os.path.isdir(self.store_path):
+                futures.extend(executor.submit(self.CheckObject, name, path) for name, path in SegmentStore(self.store_path).ListObjects())
+
+            for future in concurrent.futures.as_completed(futures):
+                kind, problem = future.result()
+                self.checked[kind] += 1
+                if problem is not None:
+                    problems.append(problem)
+        if manifest is not None:
+            manifest.Close()
+        return problems
+
+    def CheckSegment(self, lesson_path, uri, length, checksum):
+        path = os.path.join(lesson_path, uri)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return 'segment', Problem('segment', path, "missing", lesson_path, uri)
+        if stat.st_size != length:
+            return 'segment', Problem('segment', path, "{} bytes instead of {}".format(stat.st_size, length), lesson_path, uri)
+        if self.__getDigest(path, stat) != checksum:
+            return 'segment', Problem('segment', path, "SHA-256 doesn't match the manifest", lesson_path, uri)
+        return 'segment', None
+
+    def CheckDecrypted(self, lesson_path, path):
+        validator = decrypt.TsValidator(name='Decrypted file')
+        try:
+            with open(path, 'rb') as d:
+                for chunk in iter(lambda: d.read(Verifier.__CHUNK_SIZE), b''):
+                    validator.write(chunk)
+            validator.Finalize()
+        except Exception as e:
+            return 'decrypted', Problem('decrypted', path, str(e), lesson_path)
+        return 'decrypted', None
+
+    def CheckObject(self, name, path):
+        if self.__getDigest(path, os.stat(path)) != name:
+            return 'object', Problem('object', path, "content doesn't match its hash")
+        return 'object', None
+
+    def Repair(self, problems):
+        """Remove what is corrupted and forget it in the manifest, so that the next run downloads it again."""
+        manifest = Manifest(os.path.join(self.root, 'manifest.db'))
+        for problem in problems:
+            if os.path.isfile(problem.path):
+                os.remove(problem.path)
+            if problem.lesson_path is None:
+                continue
+            lesson = os.path.basename(problem.lesson_path)
+            if problem.kind == 'segment':
+                manifest.InvalidateSegment(lesson, problem.uri)
+            else:
+                manifest.InvalidateLesson(lesson)
+            manifest.InvalidateCourse(os.path.basename(os.path.dirname(problem.lesson_path)))
+        manifest.Close()
+
+    def Prune(self):
+        """Remove store objects no lesson links to anymore. Returns how many were removed."""
+        if not os.path.isdir(self.store_path):
+            return 0
+        pruned = 0
+        for _, path in SegmentStore(self.store_path).ListObjects():
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
+                pruned += 1
+        return pruned
+
+    def __getDigest(self, path, stat):
+        """SHA-256 of the file, computed once per inode."""
+        inode = (stat.st_dev, stat.st_ino)
+        with self.__lock:
+            if inode in self.__digests:
+                return self.__digests[inode]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(Verifier.__CHUNK_SIZE), b''):
+                digest.update(chunk)
+        with self.__lock:
+            self.__digests[inode] = digest.hexdigest()
+        return self.__digests[inode]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Number of files checked in parallel.')
+    parser.add_argument('--repair', action='store_true', help='Remove corrupted files and mark them to be downloaded again.')
+    parser.add_argument('--prune', action='store_true', help='Remove store objects no longer linked by any lesson.')
+    args = parser.parse_args()
+
+    verifier = Verifier(jobs=args.jobs)
+    start = time.monotonic()
+    problems = verifier.Verify()
+    for problem in sorted(problems, key=lambda x: x.path):
+        print("✕ {}: {}.".format(problem.path, problem.message.rstrip('.')))
+    print("{} segments, {} decrypted files and {} store objects checked in {:.1f}s: {} problems.".format(
+        verifier.checked['segment'], verifier.checked['decrypted'], verifier.checked['object'], time.monotonic() - start, len(problems)))
+
+    if problems and args.repair:
+        verifier.Repair(problems)
+        print("Corrupted files removed, they will be downloaded again on the next run.")
+    if args.prune:
+        print("{} unused store objects removed.".format(verifier.Prune()))
+    sys.exit(1 if problems and not args.repair else 0)